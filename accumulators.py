@@ -27,6 +27,9 @@ parts of the data.
 '''
 
 import abc
+import os
+import tempfile
+import weakref
 import numpy as np
 from collections import deque
 import time
@@ -74,6 +77,108 @@ class Accumulator(abc.ABC):
 
     __iadd__ = accumulate
 
+    # state protocol: subclasses implement `_state` and `_from_state`.
+    # increase `_state_version` when the layout of `_state` changes.
+    _state_version = 1
+    _registry = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        Accumulator._registry[cls.__name__] = cls
+
+    def _state(self):
+        s = '`_state(self)` is not implemented for {cls}.'
+        raise NotImplementedError(s.format(cls=self.__class__.__name__))
+
+    @classmethod
+    def _from_state(cls, state, **kwargs):
+        s = '`_from_state(cls, state)` is not implemented for {cls}.'
+        raise NotImplementedError(s.format(cls=cls.__name__))
+
+    def state_dict(self):
+        '''
+        The state of the accumulator as a flat dict of numpy arrays (no objects, no pickling),
+        including the class name and state version.
+        It can be saved with `np.savez` or as datasets of a HDF5 group (see `save_state`)
+        and restored with `from_state`.
+        '''
+        state = self._state()
+        state['_class'] = np.array(self.__class__.__name__.encode())
+        state['_version'] = np.array(self._state_version)
+        return state
+
+    @classmethod
+    def from_state(cls, state, **kwargs):
+        '''
+        Recreate an accumulator from the dict returned by `state_dict`.
+        Called on `Accumulator`, the class stored in the state is used.
+        '''
+        if '_class' in state:
+            name = _decode(state['_class'])
+            if name not in Accumulator._registry:
+                raise ValueError('unknown accumulator class {}'.format(name))
+            stored = Accumulator._registry[name]
+            if not issubclass(stored, cls):
+                raise TypeError('state of {} can not be loaded as {}'.format(name, cls.__name__))
+            cls = stored
+        version = int(state.get('_version', cls._state_version))
+        if version > cls._state_version:
+            s = 'state of {cls} has version {v}, only versions up to {sv} are supported.'
+            raise ValueError(s.format(cls=cls.__name__, v=version, sv=cls._state_version))
+        state = {k: v for k, v in state.items() if not k.startswith('_')}
+        return cls._from_state(state, **kwargs)
+
+
+def _decode(a):
+    '''
+    string from a bytes (or str) array of a state
+    '''
+    a = np.asarray(a)[()]
+    return a.decode() if isinstance(a, bytes) else str(a)
+
+
+def sub_state(state, prefix):
+    '''
+    the part of a state dict belonging to a nested accumulator.
+    '''
+    return {k[len(prefix):]: v for k, v in state.items() if k.startswith(prefix)}
+
+
+def prefix_state(state, prefix):
+    '''
+    the state of a nested accumulator as part of the parent's state.
+    '''
+    return {prefix + k: v for k, v in state.items()}
+
+
+def save_state(filename, acc):
+    '''
+    Save the state of an accumulator to a .npz or (if h5py is installed) .h5/.hdf5 file.
+    Use `load_state` to restore it.
+    '''
+    state = acc.state_dict()
+    if str(filename).endswith(('.h5', '.hdf5')):
+        import h5py
+        with h5py.File(filename, 'w') as f:
+            for key, value in state.items():
+                f.create_dataset(key, data=value)
+    else:
+        np.savez(filename, **state)
+
+
+def load_state(filename, **kwargs):
+    '''
+    Load an accumulator saved by `save_state`.
+    '''
+    if str(filename).endswith(('.h5', '.hdf5')):
+        import h5py
+        with h5py.File(filename, 'r') as f:
+            state = {key: f[key][()] for key in f.keys()}
+    else:
+        with np.load(filename) as f:
+            state = {key: f[key] for key in f.files}
+    return Accumulator.from_state(state, **kwargs)
+
 
 class Counter(Accumulator):
     '''
@@ -92,6 +197,13 @@ class Counter(Accumulator):
     def _accumulate_other(self, other):
         self._n += other._n
 
+    def _state(self):
+        return {'n': np.asarray(self._n)}
+
+    @classmethod
+    def _from_state(cls, state):
+        return cls(n=int(state['n']))
+
     @property
     def value(self):
         return self._n
@@ -114,14 +226,34 @@ class _BinaryOpAccumulatorNumpy(Accumulator):
     def _accumulate_obj(self, obj):
         self._n += 1
         if self.acc is None:
-            self.acc = np.asarray(obj)
+            # copy, the accumulator is modified inplace
+            self.acc = np.array(obj)
             return
         self.__class__._operator(self.acc, obj, out=self.acc)
 
     def _accumulate_other(self, other):
-        self.__class__._operator(self.acc, other.acc, out=self.acc)
+        if other.acc is None:
+            return
+        if self.acc is None:
+            self.acc = np.array(other.acc)
+        else:
+            self.__class__._operator(self.acc, other.acc, out=self.acc)
         self._n += other._n
 
+    def _state(self):
+        state = {'n': np.asarray(self._n)}
+        if self.acc is not None:
+            state['acc'] = np.asarray(self.acc)
+        return state
+
+    @classmethod
+    def _from_state(cls, state):
+        ret = cls()
+        ret._n = int(state['n'])
+        if 'acc' in state:
+            ret.acc = np.array(state['acc'])
+        return ret
+
     @property
     def value(self):
         return self.acc
@@ -163,10 +295,23 @@ class Mean(Accumulator):
         self._val += obj / self._n - self._val / self._n
 
     def _accumulate_other(self, other):
+        if other.n == 0:
+            return
         ntot = self.n + other.n
         self._val = self._val * (self.n / ntot) + other._val * (other.n / ntot)
         self._n += other._n
 
+    def _state(self):
+        return {'value': np.asarray(self._val), 'n': np.asarray(self._n)}
+
+    @classmethod
+    def _from_state(cls, state):
+        value = np.array(state['value'])
+        if value.ndim == 0:
+            # keep scalars scalar, so accumulating arrays is still possible
+            value = value[()]
+        return cls(value=value, n=int(state['n']))
+
     @property
     def value(self):
         return self._val
@@ -198,6 +343,17 @@ class RunningMean(Accumulator):
         alpha = max(self.alpha, 1 / self._n)
         self.acc = self.acc * (1 - alpha) + obj * alpha
 
+    def _state(self):
+        return {'acc': np.asarray(self.acc), 'n': np.asarray(self._n), 'lifetime': np.asarray(self.lifetime)}
+
+    @classmethod
+    def _from_state(cls, state):
+        ret = cls(lifetime=float(state['lifetime']))
+        acc = np.array(state['acc'])
+        ret.acc = acc[()] if acc.ndim == 0 else acc
+        ret._n = int(state['n'])
+        return ret
+
     @property
     def value(self):
         return self.acc
@@ -236,12 +392,26 @@ class Variance(Accumulator):
     def _accumulate_other(self, other):
         # for explanation of the formulas, see
         # https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
+        if other.n == 0:
+            return
         dmean = self.mean.value - other.mean.value
         newn = self.n + other.n
         newvar = self.var.sum + other.var.sum + dmean ** 2 * self.n * other.n / newn
         self.mean += other.mean
         self.var = Mean(value=newvar / newn, n=newn)
 
+    def _state(self):
+        state = prefix_state(self.mean.state_dict(), 'mean.')
+        state.update(prefix_state(self.var.state_dict(), 'var.'))
+        return state
+
+    @classmethod
+    def _from_state(cls, state):
+        ret = cls()
+        ret.mean = Accumulator.from_state(sub_state(state, 'mean.'))
+        ret.var = Accumulator.from_state(sub_state(state, 'var.'))
+        return ret
+
     @property
     def n(self):
         return self.mean.n
@@ -302,12 +472,26 @@ class Covariance(Accumulator):
     def _accumulate_other(self, other):
         # for explanation of the formulas, see
         # https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
+        if other.n == 0:
+            return
         dmean = self.mean.value - other.mean.value
         newn = self.n + other.n
         newvar = self._cov.sum + other._cov.sum + np.outer(dmean, dmean) * self.n * other.n / newn
         self.mean += other.mean
         self._cov = Mean(value=newvar / newn, n=newn)
 
+    def _state(self):
+        state = prefix_state(self.mean.state_dict(), 'mean.')
+        state.update(prefix_state(self._cov.state_dict(), 'cov.'))
+        return state
+
+    @classmethod
+    def _from_state(cls, state):
+        ret = cls()
+        ret.mean = Accumulator.from_state(sub_state(state, 'mean.'))
+        ret._cov = Accumulator.from_state(sub_state(state, 'cov.'))
+        return ret
+
     @property
     def n(self):
         return self.mean.n
@@ -380,6 +564,25 @@ class CacheAccumulator(Accumulator):
         self._cache = cache
         self._timecache = ctimes
 
+    def _state(self):
+        maxlen = self._cache.maxlen
+        state = {'length': np.asarray(-1 if maxlen is None else maxlen), 'n': np.asarray(self._n),
+                 'times': np.array(self._timecache, dtype=np.int64)}
+        if len(self._cache):
+            # the cached elements have to be stackable
+            state['cache'] = np.stack([np.asarray(el) for el in self._cache])
+        return state
+
+    @classmethod
+    def _from_state(cls, state):
+        length = int(state['length'])
+        ret = cls(length=None if length < 0 else length)
+        ret._n = int(state['n'])
+        if 'cache' in state:
+            ret._cache.extend(el[()] if el.ndim == 0 else el for el in np.asarray(state['cache']))
+        ret._timecache.extend(int(t) for t in state['times'])
+        return ret
+
     @property
     def value(self):
         '''
@@ -674,6 +877,24 @@ class CDFEstimator(Accumulator):
     def _debug_info(self):
         return self._n, self.m_pos, self.m_height
 
+    def _state(self):
+        state = {'q_desired': np.array(self.q_desired), 'n': np.asarray(self._n)}
+        if self.m_pos is not None:
+            state['m_pos'] = self.m_pos
+            state['m_height'] = self.m_height
+        return state
+
+    @classmethod
+    def _from_state(cls, state):
+        # subclasses have different __init__ arguments
+        ret = cls.__new__(cls)
+        CDFEstimator.__init__(ret, state['q_desired'])
+        ret._n = int(state['n'])
+        if 'm_pos' in state:
+            ret.m_pos = np.array(state['m_pos'], dtype=float)
+            ret.m_height = np.array(state['m_height'], dtype=float)
+        return ret
+
 
 class QuantileEstimator(CDFEstimator):
 
@@ -686,6 +907,17 @@ class QuantileEstimator(CDFEstimator):
     def value(self):
         return self.m_height[2]
 
+    def _state(self):
+        state = super()._state()
+        state['p'] = np.asarray(self.p)
+        return state
+
+    @classmethod
+    def _from_state(cls, state):
+        ret = super()._from_state(state)
+        ret.p = float(state['p'])
+        return ret
+
 
 class MedianEstimator(QuantileEstimator):
     '''
@@ -696,10 +928,15 @@ class MedianEstimator(QuantileEstimator):
         super().__init__(0.5)
 
 
+def _identity(x):
+    # module level function instead of a lambda, so BinSorters can be pickled
+    return x
+
+
 class BinSorter(Accumulator):
 
     def __init__(self, bin_edges, binaccumulatorcls=Counter, kwargs={},
-                 key=lambda x: x, datakey=lambda x: x):
+                 key=_identity, datakey=_identity):
         '''
         Sorts objects into accumulators for each bin. The simplest use case is to
         create a histogram. However, the accumulator class to be used in each bin
@@ -733,6 +970,33 @@ class BinSorter(Accumulator):
         idx = np.digitize(s, self.bin_edges)
         self._binaccs[idx].accumulate(d)
 
+    def _accumulate_other(self, other):
+        if not np.array_equal(self.bin_edges, other.bin_edges):
+            raise ValueError('only BinSorters with the same bin_edges can be accumulated.')
+        for acc, otheracc in zip(self._binaccs, other._binaccs):
+            acc.accumulate(otheracc)
+        self._n += other._n
+
+    def _state(self):
+        state = {'bin_edges': np.asarray(self.bin_edges), 'n': np.asarray(self._n)}
+        for i, acc in enumerate(self._binaccs):
+            state.update(prefix_state(acc.state_dict(), 'bins.{}.'.format(i)))
+        return state
+
+    @classmethod
+    def _from_state(cls, state, key=_identity, datakey=_identity):
+        '''
+        `key` and `datakey` are functions and not part of the state.
+        '''
+        ret = cls.__new__(cls)
+        ret._bin_edges = np.array(state['bin_edges'])
+        ret._binaccs = [Accumulator.from_state(sub_state(state, 'bins.{}.'.format(i)))
+                        for i in range(len(ret._bin_edges) + 1)]
+        ret.sortkey = key
+        ret.datakey = datakey
+        ret._n = int(state['n'])
+        return ret
+
     @property
     def value(self):
         return self.bin_edges, self._binaccs[1:-1]
@@ -764,7 +1028,7 @@ class BinSorter(Accumulator):
 class DynamicBinSorter(BinSorter):
 
     def __init__(self, nbins, binaccumulatorcls=Counter, kwargs={},
-                 key=lambda x: x, datakey=lambda x: x):
+                 key=_identity, datakey=_identity):
         '''
         Same as the `BinSorter`, but the `bin_edges` are dynamically adjusted using the
         `CDFEstimator`.
@@ -802,6 +1066,32 @@ class DynamicBinSorter(BinSorter):
             idx -= 1
         self._binaccs[idx].accumulate(d)
 
+    def _accumulate_other(self, other):
+        s = 'DynamicBinSorters can not be accumulated, the bin_edges depend on the order of the data.'
+        raise NotImplementedError(s)
+
+    def _state(self):
+        state = {'nbins': np.asarray(self._nbins), 'n': np.asarray(self._n)}
+        state.update(prefix_state(self.cdfestimator.state_dict(), 'cdfestimator.'))
+        for i, acc in enumerate(self._binaccs):
+            state.update(prefix_state(acc.state_dict(), 'bins.{}.'.format(i)))
+        return state
+
+    @classmethod
+    def _from_state(cls, state, key=_identity, datakey=_identity):
+        '''
+        `key` and `datakey` are functions and not part of the state.
+        '''
+        ret = cls.__new__(cls)
+        ret._nbins = int(state['nbins'])
+        ret.cdfestimator = Accumulator.from_state(sub_state(state, 'cdfestimator.'))
+        ret._binaccs = [Accumulator.from_state(sub_state(state, 'bins.{}.'.format(i)))
+                        for i in range(ret._nbins)]
+        ret.sortkey = key
+        ret.datakey = datakey
+        ret._n = int(state['n'])
+        return ret
+
     @property
     def value(self):
         return self.bin_edges, self._binaccs
@@ -812,4 +1102,505 @@ class DynamicBinSorter(BinSorter):
         returns `bin_edges` and `histogram`, identical to `np.histogram`.
         `bin_edges` always has one element more than `histogram`.
         '''
-        return self.bin_edges, [x.n for x in self._binaccs]
\ No newline at end of file
+        return self.bin_edges, [x.n for x in self._binaccs]
+
+class ScanBinner(Accumulator):
+    '''
+    Bins shots by a scan coordinate (i.e. a motor position from the database) and
+    sums their values (scalars or images) per bin, vectorized over many shots.
+
+    `bin_edges` are the edges of the bins, as in `np.histogram` the last bin includes
+    its right edge. Shots outside of the bins (or with a nan coordinate) are ignored.
+
+    Use `add(coords, values)` with the coordinates (n,) and values (n, ...) of n shots,
+    or accumulate `(coord, value)` of a single shot. The shots of a batch are grouped by bin
+    and each bin is reduced with one sum (scalars with one `np.bincount`), instead of a
+    python accumulator per shot as in `BinSorter`. ScanBinners with the same `bin_edges` can be accumulated, i.e. the
+    ScanBinners of the runs of a scan.
+
+    `value` is the mean per bin (nan for empty bins), `sum` and `counts` the sum and the
+    number of shots per bin.
+    '''
+
+    def __init__(self, bin_edges):
+        self._bin_edges = np.asarray(bin_edges, dtype=float)
+        if self._bin_edges.ndim != 1 or len(self._bin_edges) < 2 or np.any(np.diff(self._bin_edges) <= 0):
+            raise ValueError('bin_edges must be increasing with at least two edges.')
+        self._sum = None
+        self._counts = np.zeros(self.nbins, dtype=np.int64)
+
+    @property
+    def nbins(self):
+        return len(self._bin_edges) - 1
+
+    @property
+    def bin_edges(self):
+        return self._bin_edges
+
+    @property
+    def centers(self):
+        return (self._bin_edges[1:] + self._bin_edges[:-1]) / 2
+
+    def bin_indices(self, coords):
+        '''
+        the bin of each coordinate, -1 for coordinates outside of the bins.
+        '''
+        coords = np.asarray(coords, dtype=float)
+        idx = np.searchsorted(self._bin_edges, coords, side='right') - 1
+        idx[coords == self._bin_edges[-1]] = self.nbins - 1
+        idx[(idx < 0) | (idx >= self.nbins) | np.isnan(coords)] = -1
+        return idx
+
+    def groups(self, coords):
+        '''
+        the indices into coords of the shots in each bin, as dict of bin: indices (only non-empty bins).
+        '''
+        idx = self.bin_indices(coords)
+        order = np.argsort(idx, kind='stable')
+        starts = np.searchsorted(idx[order], np.arange(self.nbins + 1))
+        return {b: order[starts[b]:starts[b + 1]] for b in range(self.nbins) if starts[b + 1] > starts[b]}
+
+    def add(self, coords, values):
+        '''
+        add the values (n, ...) of n shots with the coordinates coords (n,).
+        '''
+        idx = self.bin_indices(np.atleast_1d(coords))
+        values = np.asarray(values)
+        if len(values) != len(idx):
+            raise ValueError('{} coordinates but {} values'.format(len(idx), len(values)))
+        if self._sum is None:
+            self._sum = np.zeros((self.nbins,) + values.shape[1:])
+        inside = idx >= 0
+        if not inside.all():
+            idx, values = idx[inside], values[inside]
+        if len(idx) == 0:
+            return self
+        if values.ndim == 1:
+            self._sum += np.bincount(idx, values, minlength=self.nbins)
+        else:
+            # one reduction over the shots of each bin, much faster than np.add.at for images
+            order = np.argsort(idx, kind='stable')
+            bounds = np.flatnonzero(np.diff(idx[order])) + 1
+            for shots in np.split(order, bounds):
+                self._sum[idx[shots[0]]] += values[shots].sum(axis=0)
+        self._counts += np.bincount(idx, minlength=self.nbins)
+        return self
+
+    def _accumulate_obj(self, obj):
+        coord, value = obj
+        self.add([coord], np.asarray(value)[None])
+
+    def _accumulate_other(self, other):
+        if not np.array_equal(self.bin_edges, other.bin_edges):
+            raise ValueError('only ScanBinners with the same bin_edges can be accumulated.')
+        if other._sum is None:
+            return
+        if self._sum is None:
+            self._sum = np.zeros_like(other._sum)
+        self._sum += other._sum
+        self._counts += other._counts
+
+    def _state(self):
+        state = {'bin_edges': self._bin_edges, 'counts': self._counts}
+        if self._sum is not None:
+            state['sum'] = self._sum
+        return state
+
+    @classmethod
+    def _from_state(cls, state):
+        ret = cls(state['bin_edges'])
+        ret._counts[...] = state['counts']
+        if 'sum' in state:
+            ret._sum = np.array(state['sum'], dtype=float)
+        return ret
+
+    @property
+    def value(self):
+        if self._sum is None:
+            return None
+        counts = self._counts.reshape((-1,) + (1,) * (self._sum.ndim - 1))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self._sum / counts
+
+    @property
+    def sum(self):
+        return self._sum
+
+    @property
+    def counts(self):
+        return self._counts
+
+    @property
+    def n(self):
+        return int(self._counts.sum())
+
+
+class SharedBuffer:
+    '''
+    A block of memory shared between processes.
+
+    It is backed by a file in /dev/shm (the POSIX shared memory on linux)
+    and pickles as a reference to that file, so sending it to a worker process
+    does not copy the data. The creating instance removes the file when it is
+    garbage collected; arrays created by `array` stay valid as long as they are referenced.
+    '''
+
+    _dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+    def __init__(self, nbytes, filename=None):
+        self.nbytes = nbytes
+        if filename is None:
+            fd, filename = tempfile.mkstemp(prefix='accumulator_', dir=self._dir)
+            os.ftruncate(fd, max(nbytes, 1))
+            os.close(fd)
+            self._finalizer = weakref.finalize(self, os.unlink, filename)
+        self.filename = filename
+        self._mmap = np.memmap(filename, dtype=np.uint8, mode='r+', shape=(max(nbytes, 1),))
+
+    def __reduce__(self):
+        return (self.__class__, (self.nbytes, self.filename))
+
+    def array(self, shape, dtype, offset=0):
+        '''
+        an array backed by the buffer at `offset` bytes.
+        '''
+        return np.ndarray(shape, dtype=dtype, buffer=self._mmap, offset=offset)
+
+
+class SparseSum(Accumulator):
+    '''
+    Sum image of sparse frames (objects with the flat pixel indices `index`,
+    the values `value` and the image `shape`, see `sparse.SparseFrame`)
+    without making the frames dense. Also counts the hits per pixel.
+
+    `value` is the mean image (sum / number of frames), `sum` and `counts` the
+    sum and the number of hits of each pixel.
+    '''
+
+    def __init__(self, shape=None):
+        self._shape = None if shape is None else tuple(shape)
+        self._sum = None if shape is None else np.zeros(self._shape)
+        self._counts = None if shape is None else np.zeros(self._shape, dtype=np.int64)
+        self._n = 0
+
+    def _accumulate_obj(self, obj):
+        if self._sum is None:
+            self.__init__(obj.shape)
+        elif tuple(obj.shape) != self._shape:
+            raise ValueError('shape {} of the frame does not match {}'.format(tuple(obj.shape), self._shape))
+        # the indices of a frame are unique, so fancy indexing adds each value once
+        self._sum.ravel()[obj.index] += obj.value
+        self._counts.ravel()[obj.index] += 1
+        self._n += 1
+
+    def _accumulate_other(self, other):
+        if other.n == 0 or other._sum is None:
+            self._n += other.n
+            return
+        if self._sum is None:
+            self.__init__(other._shape)
+        self._sum += other._sum
+        self._counts += other._counts
+        self._n += other.n
+
+    def _state(self):
+        state = {'n': np.asarray(self._n)}
+        if self._sum is not None:
+            state.update(sum=self._sum, counts=self._counts)
+        return state
+
+    @classmethod
+    def _from_state(cls, state):
+        ret = cls()
+        if 'sum' in state:
+            ret.__init__(np.shape(state['sum']))
+            ret._sum[...] = state['sum']
+            ret._counts[...] = state['counts']
+        ret._n = int(state['n'])
+        return ret
+
+    @property
+    def value(self):
+        if self._sum is None:
+            return None
+        return self._sum / max(self._n, 1)
+
+    @property
+    def sum(self):
+        return self._sum
+
+    @property
+    def counts(self):
+        return self._counts
+
+    @property
+    def n(self):
+        return self._n
+
+
+class PerShotRecorder(Accumulator):
+    '''
+    Records values per shot into preallocated, typed columns.
+
+    n_shots: number of shots (rows) to record.
+    columns: dict of name: dtype or name: (dtype, shape) for fixed shape vector columns,
+             e.g. {'total': float, 'spectrum': (float, (1024,))}
+    shared: if True, the columns live in a `SharedBuffer`, so the recorder can be sent
+            to worker processes which write into the same memory.
+
+    Use `record(index, name=value, ...)` or accumulate `(index, {name: value})`.
+    `value` is the dict of columns (no copy). Rows never recorded are zero.
+    '''
+
+    _align = 64
+
+    def __init__(self, n_shots, columns, shared=False):
+        self.n_shots = n_shots
+        layout = {}
+        offset = 0
+        for name, spec in dict(columns, _recorded=bool).items():
+            if isinstance(spec, (tuple, list)):
+                dtype, shape = spec
+            else:
+                dtype, shape = spec, ()
+            dtype = np.dtype(dtype)
+            shape = (n_shots,) + tuple(shape)
+            layout[name] = (shape, dtype.str, offset)
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            offset += -(-nbytes // self._align) * self._align
+        self._layout = layout
+        self._buffer = SharedBuffer(offset) if shared else None
+        self._make_columns()
+
+    def _make_columns(self):
+        if self._buffer is None:
+            self._columns = {name: np.zeros(shape, dtype) for name, (shape, dtype, _) in self._layout.items()}
+        else:
+            self._columns = {name: self._buffer.array(shape, dtype, offset)
+                             for name, (shape, dtype, offset) in self._layout.items()}
+        self._recorded = self._columns.pop('_recorded')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self._buffer is not None:
+            # the columns are recreated from the shared buffer on unpickling
+            del state['_columns'], state['_recorded']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._buffer is not None:
+            self._make_columns()
+
+    @property
+    def shared(self):
+        return self._buffer is not None
+
+    def record(self, index, **values):
+        for name, value in values.items():
+            self._columns[name][index] = value
+        self._recorded[index] = True
+
+    def _accumulate_obj(self, obj):
+        index, values = obj
+        self.record(index, **values)
+
+    def _accumulate_other(self, other):
+        if self._buffer is not None and other._buffer is not None \
+                and self._buffer.filename == other._buffer.filename:
+            # same shared memory, already written
+            return
+        rows = other._recorded
+        for name, column in self._columns.items():
+            column[rows] = other._columns[name][rows]
+        self._recorded |= rows
+
+    def merge_rows(self, other, rows_other, rows_self):
+        '''
+        copy the recorded rows `rows_other` of `other` into the rows `rows_self`.
+        can be used to combine recorders with a different number of shots.
+        '''
+        rows_other = np.asarray(rows_other, dtype=int)
+        rows_self = np.asarray(rows_self, dtype=int)
+        recorded = other._recorded[rows_other]
+        rows_other, rows_self = rows_other[recorded], rows_self[recorded]
+        for name, column in self._columns.items():
+            column[rows_self] = other._columns[name][rows_other]
+        self._recorded[rows_self] = True
+
+    def _state(self):
+        state = {'columns.' + name: column for name, column in self._columns.items()}
+        state['recorded'] = self._recorded
+        return state
+
+    @classmethod
+    def _from_state(cls, state, shared=False):
+        columns = sub_state(state, 'columns.')
+        ret = cls(len(state['recorded']), {name: (c.dtype, c.shape[1:]) for name, c in columns.items()}, shared=shared)
+        for name, column in ret._columns.items():
+            column[...] = columns[name]
+        ret._recorded[...] = state['recorded']
+        return ret
+
+    @property
+    def columns(self):
+        return tuple(self._columns)
+
+    @property
+    def recorded(self):
+        return self._recorded
+
+    @property
+    def value(self):
+        return self._columns
+
+    @property
+    def n(self):
+        return int(np.count_nonzero(self._recorded))
+
+
+class _SharedSlotAccumulator(Accumulator):
+    '''
+    Baseclass for accumulators in shared memory for parallel workers.
+
+    The data lives in a `SharedBuffer` with one slot per worker, shape (slots, *shape).
+    A worker process gets the accumulator (it pickles as a reference to the shared memory)
+    and accumulates into its own slot via `acc.slot(i).accumulate(obj)`, so no locks are needed
+    and nothing has to be sent back. The value is obtained by one reduction over the slots.
+    Each slot must only be used by one worker at a time.
+
+    `state_dict` returns the state of the equivalent plain accumulator (see `to_local`).
+    '''
+    def __init__(self, shape, slots, dtype=float):
+        self.shape = tuple(int(x) for x in np.atleast_1d(shape))
+        self.slots = slots
+        self.dtype = np.dtype(dtype).str
+        nbytes = int(np.prod((slots,) + self.shape)) * np.dtype(dtype).itemsize
+        self._countoffset = -(-nbytes // 64) * 64
+        self._buffer = SharedBuffer(self._countoffset + slots * 8)
+        self._slot = None
+        self._make_arrays()
+        self._data[...] = self._initial(np.dtype(dtype))
+
+    @staticmethod
+    def _initial(dtype):
+        '''
+        the initial value of the slots for `dtype`.
+        '''
+        return 0
+
+    def _make_arrays(self):
+        self._data = self._buffer.array((self.slots,) + self.shape, self.dtype)
+        self._counts = self._buffer.array((self.slots,), np.int64, self._countoffset)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_data'], state['_counts']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._make_arrays()
+
+    def slot(self, i):
+        '''
+        the accumulator of slot `i`, writing to the shared memory.
+        '''
+        if not 0 <= i < self.slots:
+            raise IndexError('slot {} out of range for {} slots'.format(i, self.slots))
+        view = self.__class__.__new__(self.__class__)
+        view.__setstate__(self.__getstate__())
+        view._slot = i
+        return view
+
+    def _accumulate_obj(self, obj):
+        if self._slot is None:
+            raise ValueError('use `slot(i).accumulate(obj)` to accumulate into a shared accumulator.')
+        self.__class__._operator(self._data[self._slot], obj, out=self._data[self._slot])
+        self._counts[self._slot] += 1
+
+    def _accumulate_other(self, other):
+        if other._buffer.filename != self._buffer.filename:
+            s = 'only slots of the same shared accumulator can be accumulated, use `to_local`.'
+            raise NotImplementedError(s)
+        # same shared memory, nothing to do
+
+    def _used(self):
+        if self._slot is None:
+            return self._data[self._counts > 0]
+        return self._data[self._slot:self._slot + 1]
+
+    @property
+    def n(self):
+        if self._slot is None:
+            return int(self._counts.sum())
+        return int(self._counts[self._slot])
+
+    def state_dict(self):
+        return self.to_local().state_dict()
+
+
+class SharedMean(_SharedSlotAccumulator):
+    '''
+    Mean over all data accumulated by parallel workers in shared memory.
+    See `_SharedSlotAccumulator`.
+    '''
+    _operator = np.add
+
+    @property
+    def value(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self._used().sum(axis=0) / self.n
+
+    def to_local(self):
+        if self.n == 0:
+            return Mean()
+        return Mean(value=self.value, n=self.n)
+
+
+class SharedMaximum(_SharedSlotAccumulator):
+    '''
+    Maximum over all data accumulated by parallel workers in shared memory.
+    See `_SharedSlotAccumulator`.
+    '''
+    _operator = np.maximum
+
+    @staticmethod
+    def _initial(dtype):
+        return np.iinfo(dtype).min if dtype.kind in 'iu' else -np.inf
+
+    @property
+    def value(self):
+        if self.n == 0:
+            return None
+        return self._used().max(axis=0)
+
+    def to_local(self):
+        ret = Maximum()
+        if self.n > 0:
+            ret.acc, ret._n = self.value, self.n
+        return ret
+
+
+class SharedMinimum(_SharedSlotAccumulator):
+    '''
+    Minimum over all data accumulated by parallel workers in shared memory.
+    See `_SharedSlotAccumulator`.
+    '''
+    _operator = np.minimum
+
+    @staticmethod
+    def _initial(dtype):
+        return np.iinfo(dtype).max if dtype.kind in 'iu' else np.inf
+
+    @property
+    def value(self):
+        if self.n == 0:
+            return None
+        return self._used().min(axis=0)
+
+    def to_local(self):
+        ret = Minimum()
+        if self.n > 0:
+            ret.acc, ret._n = self.value, self.n
+        return ret
@@ -0,0 +1,199 @@
+# felix zimmermann, github.com/fzimmermann89 for beamtime kuschel2023
+
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from data_helper import accumulator_from_results
+import codec
+
+
+def run_files(path, minrun=0, maxrun=9313254):
+    """
+    result files data*run{runnr}.npz in path with minrun<=runnr<=maxrun, sorted by run number
+
+    Returns
+    -------
+    list of (runnr, file)
+    """
+    ret = []
+    for file in Path(path).glob("data*.npz"):
+        try:
+            runnr = int(file.stem.split("run")[-1])
+        except ValueError:
+            continue
+        if minrun <= runnr <= maxrun:
+            ret.append((runnr, file))
+    return sorted(ret)
+
+
+def _group_key(file, groupby, reduce):
+    with codec.load(file) as f:
+        if callable(groupby):
+            return groupby(f)
+        return reduce(f[groupby])
+
+
+def _map_files(files, func, fields):
+    """
+    load fields of files and apply func to each. runs in the worker processes.
+    """
+    ret = []
+    for file in files:
+        with codec.load(file) as f:
+            # only the requested entries are read and decompressed
+            ret.append(func(f if fields is None else {key: f[key] for key in fields}))
+    return ret
+
+
+def _stack(values):
+    """
+    the results of func as dict of arrays, one entry per run
+    """
+    if values and all(isinstance(value, dict) for value in values):
+        keys = list(values[0])
+        for value in values[1:]:
+            keys += [key for key in value if key not in keys]
+        return {key: _stack_column([value.get(key, np.nan) for value in values]) for key in keys}
+    return {"value": _stack_column(values)}
+
+
+def _stack_column(column):
+    try:
+        return np.stack([np.asarray(c) for c in column])
+    except ValueError:
+        # different shapes
+        ret = np.empty(len(column), dtype=object)
+        ret[:] = column
+        return ret
+
+
+def _merge(accs):
+    """
+    merge a list of dicts of accumulators into the first one
+    """
+    ret = accs[0]
+    for other in accs[1:]:
+        for name, acc in other.items():
+            if name in ret:
+                ret[name].accumulate(acc)
+            else:
+                ret[name] = acc
+    return ret
+
+
+def _load_and_merge(files, names):
+    """
+    load the accumulator states of names from files and merge them.
+    runs in the worker processes.
+    """
+    accs = []
+    for file in files:
+        with codec.load(file) as f:
+            accs.append({name: accumulator_from_results(f, name) for name in names})
+    return _merge(accs)
+
+
+def aggregate_runs(path, names, groupby=None, reduce=np.median, decimals=None, bins=None, minrun=0, maxrun=9313254, runs=None, workers=4, chunksize=4):
+    """
+    Merges the accumulators saved by to_dict across runs, i.e. shot weighted means over many runs,
+    grouped by a per run value such as the median sampleY or the attenuator thickness.
+
+    The group keys are read in parallel, then for each group the files are split into chunks
+    of chunksize, each chunk is loaded and merged in a worker and the chunk results are merged
+    in order here, so each is sent from the workers only once.
+
+    Parameters
+    ----------
+    path: folder of the result files (data*run{runnr}.npz)
+    names: names of the accumulators to merge, i.e. ["side_mean", "forward_mean"]
+    groupby: None (all runs in one group), name of a result field, or callable(npzfile)->key (must be picklable)
+    reduce: reduces the field to one key per run, default np.median
+    decimals: round the keys to this many decimals before grouping
+    bins: instead of exact keys, group by bins with these edges. the key is the index of the bin
+    minrun, maxrun: range of runs to use
+    runs: optional list of run numbers to use
+    workers: number of processes
+    chunksize: number of files merged in one task
+
+    Returns
+    -------
+    dict of key: dict of accumulators by name and "runs": list of run numbers, sorted by key
+    """
+    if isinstance(names, str):
+        names = [names]
+    files = run_files(path, minrun, maxrun)
+    if runs is not None:
+        runs = set(int(r) for r in runs)
+        files = [(runnr, file) for runnr, file in files if runnr in runs]
+    if len(files) == 0:
+        return {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        if groupby is None:
+            keys = [None] * len(files)
+        else:
+            keys = list(pool.map(_group_key, [file for _, file in files], [groupby] * len(files), [reduce] * len(files)))
+            if decimals is not None:
+                keys = [np.round(key, decimals) for key in keys]
+            if bins is not None:
+                keys = list(np.digitize(keys, bins))
+            keys = [key.item() if isinstance(key, np.generic) else key for key in keys]
+        groups = {}
+        for key, (runnr, file) in zip(keys, files):
+            groups.setdefault(key, []).append((runnr, file))
+        futures = {}
+        for key, group in groups.items():
+            groupfiles = [file for _, file in group]
+            futures[key] = [pool.submit(_load_and_merge, groupfiles[i:i + chunksize], names) for i in range(0, len(groupfiles), chunksize)]
+        ret = {}
+        for key in sorted(groups, key=lambda k: (k is None, k)):
+            merged = _merge([f.result() for f in futures[key]])
+            merged["runs"] = [runnr for runnr, _ in groups[key]]
+            ret[key] = merged
+    return ret
+
+
+def map_runs(path, func, runs=None, fields=None, workers=4, minrun=0, maxrun=9313254, chunksize=8):
+    """
+    Applies a reduction to many result files in parallel processes, i.e. a signal and the motor position per run of a scan.
+    Only the fields are loaded from each file, func runs in the workers, so only its result is sent back.
+
+    Parameters
+    ----------
+    path: folder of the result files (data*run{runnr}.npz)
+    func: callable(data)->value, data is a dict of fields (or the Results of the file if fields is None).
+        the value can be a scalar, an array or a dict of those. must be picklable, i.e. a function defined with def.
+    runs: optional list of run numbers to use
+    fields: names of the result fields to load, None for all (loaded on access)
+    workers: number of processes, 1 to run in this process
+    minrun, maxrun: range of runs to use
+    chunksize: number of files handled in one task
+
+    Returns
+    -------
+    dict of arrays with one entry per run, sorted by run number: runNR and, for dict values, one array per key,
+    otherwise the values as value
+
+    Usage
+    ------
+    def signal(data):
+        return {"y": np.median(data["sampleY"]), "signal": np.mean(data["side_mean"])}
+    table = map_runs(path, signal, fields=["sampleY", "side_mean"], minrun=START, maxrun=END)
+    plt.plot(table["y"], table["signal"])
+    """
+    if isinstance(fields, str):
+        fields = [fields]
+    files = run_files(path, minrun, maxrun)
+    if runs is not None:
+        runs = set(int(r) for r in runs)
+        files = [(runnr, file) for runnr, file in files if runnr in runs]
+    chunks = [[file for _, file in files[i:i + chunksize]] for i in range(0, len(files), chunksize)]
+    if workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_map_files, chunks, [func] * len(chunks), [fields] * len(chunks)))
+    else:
+        results = [_map_files(chunk, func, fields) for chunk in chunks]
+    values = [value for chunk in results for value in chunk]
+    ret = {"runNR": np.array([runnr for runnr, _ in files], dtype=np.int64)}
+    if values:
+        ret.update(_stack(values))
+    return ret
@@ -1,53 +1,123 @@
 # felix zimmermann, github.com/fzimmermann89 for beamtime kuschel2023
 
-from tqdm import tqdm
-import matplotlib.pyplot as plt
+import re
+import sys
+import hashlib
+import importlib
+import time
+from functools import partial
+from concurrent.futures import Future
 import numpy as np
-from data_helper import *
+from data_helper import Run, to_dict, save_checkpoint, load_checkpoint, checkpoint_file
 import accumulators
 from pathlib import Path
-from filters import *
-from calculators import *
+from filters import filter_shutter, filter_xstep
+from calculators import Histogrammer, RangeCounter, NoiseCutter, Projection, topk
 
+import codec
 import exp_config
 
-def analyserun(runNR, max_shots=np.inf, step_shots=1):
-    run=Run(exp_config.detector_keys,exp_config.database_keys, run=int(runNR))
-    
-    #accumulators
-    spectrum_mean=accumulators.Mean()
-    forward_mean=accumulators.Mean()
-    forward_hist_mean=accumulators.Mean()
-    forward_total = []
-    side_mean=accumulators.Mean()
-    side_max=accumulators.Maximum()
-    side_hist_mean=accumulators.Mean()
-    side_bright_pershot = []
-    side_total = []
-    spectrum=[]
+RESULTS = Path("/work/kuschel/2023TRsHardXray/scratch/ulmer/data/run_data/")
+
+# the modules the results of analyserun depend on, see analysis_fingerprint
+ANALYSIS_MODULES = ("analyse", "exp_config", "filters", "calculators", "corrections", "data_helper", "accumulators")
+
+
+def analysis_fingerprint():
+    """
+    hash of the source of ANALYSIS_MODULES. it is stored in the checkpoints, a checkpoint of another
+    version of the analysis (i.e. a changed threshold in exp_config or filters) is not resumed
+    """
+    h = hashlib.sha1()
+    for name in ANALYSIS_MODULES:
+        module = sys.modules[__name__] if name == "analyse" else importlib.import_module(name)
+        h.update(Path(module.__file__).read_bytes())
+    return h.hexdigest()
+
+def make_accumulators():
+    """
+    the accumulators of analyserun
+    """
+    return dict(
+        spectrum_mean=accumulators.Mean(),
+        forward_mean=accumulators.Mean(),
+        forward_hist_mean=accumulators.Mean(),
+        side_mean=accumulators.Mean(),
+        side_max=accumulators.Maximum(),
+        side_hist_mean=accumulators.Mean(),
+        top=topk(k=5), # 5 brightest images
+    )
+
+
+def merge_accumulators(*accs):
+    """
+    merge dicts of accumulators in the given order into a new dict.
+    the inputs are not modified.
+    """
+    merged = {}
+    for acc in accs:
+        for name, value in acc.items():
+            if name not in merged:
+                merged[name] = topk.from_state(value.state_dict()) if isinstance(value, topk) else accumulators.Accumulator.from_state(value.state_dict())
+            elif isinstance(value, topk):
+                merged[name].merge(value)
+            else:
+                merged[name].accumulate(value)
+    return merged
+
+
+def _merge_checkpoint(states, accs):
+    """
+    accumulators from a checkpoint merged with the ones accumulated since.
+    the accumulators in accs are not modified.
+    """
+    restored = {name: topk.from_state(states[name]) if isinstance(acc, topk) else accumulators.Accumulator.from_state(states[name]) for name, acc in accs.items() if name in states}
+    return merge_accumulators(restored, accs)
+
+
+def make_run(runNR):
+    # only the mean over the spectrometer rows is used, so only the projection is read
+    return Run(exp_config.detector_keys,exp_config.database_keys, run=int(runNR), detector_projections={"spectrometer": Projection(axis=1)})
+
+
+def process_shots(run, good_shots, rows, accs, pershot, callback=None, progress=True):
+    """
+    the analysis of each shot.
+
+    Parameters
+    ----------
+    run: Run
+    good_shots: shot indices of the rows of pershot
+    rows: rows of good_shots to process
+    accs: dict of accumulators, see make_accumulators
+    pershot: PerShotRecorder, one row per good shot
+    callback: called with the number of processed shots after each shot
+    """
+    spectrum_mean = accs["spectrum_mean"]
+    forward_mean = accs["forward_mean"]
+    forward_hist_mean = accs["forward_hist_mean"]
+    side_mean = accs["side_mean"]
+    side_max = accs["side_max"]
+    side_hist_mean = accs["side_hist_mean"]
+    top = accs["top"]
 
     #calculators
     side_hist = Histogrammer(bins=200, range=(0,50000))
     forward_hist = Histogrammer(bins=200, range=(0,50000)) 
     side_bright_counter = RangeCounter(low=40) 
-    top = topk(k=5) # 5 brightest images
     cut_noise=NoiseCutter(1000) #sets values below 1000ev to zero
+    side_roi = exp_config.side_roi
 
-    #shot filtering    
-    good_shots = filter_shutter(run)(filter_xstep(run)())
-    good_shots = good_shots[range(0,min(max_shots, len(good_shots)), step_shots)]
+    from tqdm import tqdm # slow to import
 
-    print("good_shots:",good_shots)
-    
-
-    for i in tqdm(good_shots):
+    for done, j in enumerate(tqdm(rows, disable=not progress)):
+        i = good_shots[j]
         shot = run[i]
         # do something with the data.
 
         #spectrometer
-        current_spectrum = np.mean(shot.spectrometer, axis=1)
+        current_spectrum = np.asarray(shot.spectrometer)
         spectrum_mean.accumulate(current_spectrum)
-        spectrum.append(current_spectrum)
 
         #image detectors
         side_image = cut_noise(shot.side_ccd)
@@ -59,9 +129,7 @@ def analyserun(runNR, max_shots=np.inf, step_shots=1):
         forward_mean.accumulate(forward_image)
         side_max.accumulate(shot.side_ccd)
 
-        side_bright_pershot.append(side_bright_counter(shot.side_ccd))
-        side_total.append(side_image_sum)
-        forward_total.append(forward_image_sum)
+        pershot.record(j, side_bright_pershot=side_bright_counter(shot.side_ccd), side_total=side_image_sum, side_roi_mean=side_roi.mean(side_image), forward_total=forward_image_sum, spectrum=current_spectrum)
         
         #brightest images
         dat = (forward_image_sum, side_image_sum, forward_image, side_image, i)
@@ -71,22 +139,242 @@ def analyserun(runNR, max_shots=np.inf, step_shots=1):
         #image hists
         side_hist_mean.accumulate(side_hist(shot.side_ccd))
         forward_hist_mean.accumulate(forward_hist(shot.forward_ccd))
+
+        if callback is not None:
+            callback(done + 1)
+    return accs
+
+
+def make_shared_accumulators(shot, slots):
+    """
+    shared memory versions of the image accumulators of analyserun with one slot per worker,
+    so the images do not have to be sent back from the worker processes.
+    shot: a Shot to get the image shapes from
+    """
+    side_image, forward_image = np.asarray(shot.side_ccd), np.asarray(shot.forward_ccd)
+    return dict(
+        forward_mean=accumulators.SharedMean(forward_image.shape, slots),
+        side_mean=accumulators.SharedMean(side_image.shape, slots),
+        side_max=accumulators.SharedMaximum(side_image.shape, slots, dtype=side_image.dtype),
+    )
+
+
+def _process_chunk(runNR, good_shots, rows, pershot, shared):
+    """
+    process some shots in a worker process with its own Run.
+    pershot has to be a shared PerShotRecorder, shared a dict of slots of shared accumulators,
+    only the other accumulators are returned.
+    """
+    accs = make_accumulators()
+    accs.update(shared)
+    process_shots(make_run(runNR), good_shots, rows, accs, pershot, progress=False)
+    return {name: acc for name, acc in accs.items() if name not in shared}
+
+
+def analyserun(runNR, max_shots=np.inf, step_shots=1, checkpoint=None, checkpoint_interval=300, workers=1, mode="thread"):
+    """
+    checkpoint: None or path of a checkpoint file. if given, the accumulator states and the processed tags
+        are saved every checkpoint_interval seconds (only with workers=1) and at the end. If the file exists, only shots
+        not processed yet are analysed and merged with the accumulators in the checkpoint. A checkpoint
+        written by another version of the analysis (see analysis_fingerprint) is discarded.
+    workers: number of parallel workers. the shots are split into workers contiguous chunks, each with
+        its own accumulators, which are merged in order. the result does not depend on the timing.
+    mode: "thread" (each thread with its own detector readers, most of the work are numpy functions releasing the GIL)
+        or "process" (each process with its own Run, the per shot results and the mean and max images
+        are accumulated in shared memory)
+    """
+    run=make_run(runNR)
+    accs = make_accumulators()
+
+    #shot filtering    
+    good_shots = filter_shutter(run)(filter_xstep(run)())
+    good_shots = good_shots[range(0,min(max_shots, len(good_shots)), step_shots)]
+    good_tags = run.db_frame(good_shots).tag
+
+    print("good_shots:",good_shots)
+    pershot = accumulators.PerShotRecorder(len(good_shots), {
+        "side_total": float,
+        "side_roi_mean": float,
+        "forward_total": float,
+        "side_bright_pershot": int,
+        "spectrum": (float, exp_config.spectrometer_axis_gold.shape),
+    }, shared=(workers > 1 and mode == "process"))
+
+    #resume from checkpoint
+    fingerprint = analysis_fingerprint()
+    processed_tags, states = load_checkpoint(checkpoint) if checkpoint is not None else (np.zeros(0, dtype=int), {})
+    if states and str(states.get("fingerprint", "")) != fingerprint:
+        print("the checkpoint is of another version of the analysis, starting over")
+        processed_tags, states = np.zeros(0, dtype=int), {}
+    if "pershot" in states and set(accumulators.sub_state(states["pershot"], "columns.")) != set(pershot.value):
+        print("the checkpoint has different per shot columns, starting over")
+        processed_tags, states = np.zeros(0, dtype=int), {}
+    if "pershot" in states:
+        rows = {tag: j for j, tag in enumerate(good_tags)}
+        old_rows = [j for j, tag in enumerate(states["pershot_tags"]) if tag in rows]
+        new_rows = [rows[states["pershot_tags"][j]] for j in old_rows]
+        pershot.merge_rows(accumulators.PerShotRecorder.from_state(states["pershot"]), old_rows, new_rows)
+    todo = np.flatnonzero(~np.isin(good_tags, processed_tags))
+    if len(processed_tags):
+        print(f"resuming from checkpoint, {len(processed_tags)} shots already processed")
+
+    def save(done):
+        tags = np.union1d(processed_tags, good_tags[todo[:done]])
+        save_checkpoint(checkpoint, tags, fingerprint=fingerprint, pershot=pershot, pershot_tags=good_tags, **_merge_checkpoint(states, accs))
+
+    if workers <= 1:
+        last_checkpoint = time.monotonic()
+        def callback(done):
+            nonlocal last_checkpoint
+            if checkpoint is not None and time.monotonic() - last_checkpoint > checkpoint_interval:
+                save(done)
+                last_checkpoint = time.monotonic()
+        process_shots(run, good_shots, todo, accs, pershot, callback=callback)
+    else:
+        chunks = np.array_split(todo, workers)
+        if mode == "thread":
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(process_shots, run.copy(), good_shots, chunk, make_accumulators(), pershot, progress=False) for chunk in chunks]
+        elif mode == "process":
+            from concurrent.futures import ProcessPoolExecutor
+            shared = make_shared_accumulators(run[good_shots[todo[0]]], workers) if len(todo) else {}
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(_process_chunk, runNR, good_shots, chunk, pershot, {name: acc.slot(i) for name, acc in shared.items()}) for i, chunk in enumerate(chunks)]
+        else:
+            raise ValueError("mode must be 'thread' or 'process'")
+        accs = merge_accumulators(*(f.result() for f in futures))
+        if mode == "process":
+            accs = {name: shared[name].to_local() if name in shared else accs[name] for name in make_accumulators()}
+
+    if checkpoint is not None:
+        save(len(todo))
+    accs = _merge_checkpoint(states, accs)
     
     #get values of brightest images
-    forward_top_image_sum,side_top_image_sum,forward_top_images,side_top_images,i_top_images=zip(*top.get())
+    forward_top_image_sum,side_top_image_sum,forward_top_images,side_top_images,i_top_images=zip(*accs.pop("top").get())
     
-    
-    return to_dict(run, shots_taken=good_shots, side_mean=side_mean,forward_mean=forward_mean,side_hist_mean=side_hist_mean,forward_hist_mean=forward_hist_mean,forward_hist_centers=forward_hist.centers(),side_hist_centers=side_hist.centers(),side_bright_pershot=side_bright_pershot,side_max=side_max,side_total=side_total,forward_total=forward_total, runNR=runNR,spectrum_mean=spectrum_mean,spectrum=spectrum,spectrum_axis=exp_config.spectrometer_axis_gold, 
+    side_hist = Histogrammer(bins=200, range=(0,50000))
+    forward_hist = Histogrammer(bins=200, range=(0,50000)) 
+    return to_dict(run, shots_taken=good_shots, **accs, forward_hist_centers=forward_hist.centers(),side_hist_centers=side_hist.centers(), pershot=pershot, runNR=runNR,spectrum_axis=exp_config.spectrometer_axis_gold, 
               forward_top_images=forward_top_images,    forward_top_image_sum=forward_top_image_sum,    side_top_image_sum=side_top_image_sum,    side_top_image=side_top_images,    i_top_images=i_top_images,)
 
+def parse_runs(specs):
+    """
+    run numbers from a list of strings like "1314826", "1314826-1314830" (inclusive) or "1314826,1314828".
+    a single negative number, i.e. "-1" for the newest run, is a run number, not a range
+    """
+    runs = []
+    for spec in specs:
+        for part in str(spec).split(","):
+            span = re.match(r"^(\d+)-(\d+)$", part.strip())
+            if span:
+                runs.extend(range(int(span.group(1)), int(span.group(2)) + 1))
+            elif part.strip():
+                runs.append(int(part))
+    return sorted(set(runs))
+
+
+def save_results(outpath, data, wait=True):
+    """
+    write the results atomically with a codec.ResultWriter, i.e. the file is either complete or not there.
+    the images are encoded with exp_config.result_codecs, the fields are encoded in parallel.
+    if not wait, the writing is finished in the background and a Future of the path is returned
+    """
+    writer = codec.ResultWriter(outpath, exp_config.result_codecs)
+    try:
+        writer.update(data)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.close(wait=wait)
+
+
+def _report(written, outpath):
+    """
+    a Future of True once written (a Future of save_results) is done, False if writing failed
+    """
+    ret = Future()
+
+    def done(future):
+        error = future.exception()
+        if error is None:
+            print("done", outpath)
+        else:
+            print("writing failed", outpath, repr(error))
+        ret.set_result(error is None)
+
+    written.add_done_callback(done)
+    return ret
+
+
+def analyse_and_save(runNR, outdir=RESULTS, use_checkpoint=True, workers=1, mode="thread", use_pipeline=False, wait=True, previous=None):
+    """
+    analyse one run and save the results to outdir/data1_run{runNR}.npz
+    with analyserun, or if use_pipeline with exp_config.analysis_pipeline (see pipeline.py, without checkpoints)
+    if not wait, the results are written in the background, i.e. while the next run is analysed
+    previous: None or a Future (i.e. of the previous run) waited for before writing in the background,
+        so at most one result is being written and kept in memory for it
+
+    Returns
+    -------
+    True on success, False if the analysis failed. if not wait, a Future of it
+    """
+    outpath = Path(outdir) / f"data1_run{runNR}.npz"
+    # the checkpoint is kept after the run is done, so new shots of the run can be added later
+    checkpoint = checkpoint_file(outpath) if use_checkpoint else None
+    print("will save to",outpath)     
+    try:
+        if use_pipeline:
+            from pipeline import run_pipeline
+            data = run_pipeline(runNR, exp_config.analysis_pipeline, exp_config.detector_keys, exp_config.database_keys, workers=workers, mode="auto" if workers > 1 else "serial", spectrum_axis=exp_config.spectrometer_axis_gold)
+        else:
+            data = analyserun(runNR=runNR, checkpoint=checkpoint, workers=workers, mode=mode)
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        print("failed", runNR)
+        if wait:
+            return False
+        failed = Future()
+        failed.set_result(False)
+        return failed
+    if not wait:
+        if previous is not None:
+            previous.result()
+        return _report(save_results(outpath, data, wait=False), outpath)
+    save_results(outpath, data)
+    print("done", outpath)
+    return True
+
+
 if __name__ == "__main__":
     import argparse
-    parser=argparse.ArgumentParser()
-    parser.add_argument("run")
+    parser=argparse.ArgumentParser(description="analyse runs, i.e. python analyse.py 1314826 1314830-1314840")
+    parser.add_argument("runs", nargs="+", help="run numbers or inclusive ranges START-END")
+    parser.add_argument("--outdir", default=RESULTS, help="folder for the results")
+    parser.add_argument("--no-checkpoint", action="store_true", help="do not resume from or write a checkpoint")
+    parser.add_argument("--workers", type=int, default=1, help="number of parallel workers per run")
+    parser.add_argument("--mode", default="thread", choices=["thread", "process"], help="parallelize with threads or processes")
+    parser.add_argument("--pipeline", action="store_true", help="use exp_config.analysis_pipeline instead of analyserun")
+    parser.add_argument("--jobs", type=int, default=1, help="number of runs analysed in parallel processes")
     args=parser.parse_args()
 
-    outpath=f"/work/kuschel/2023TRsHardXray/scratch/ulmer/data/run_data/data1_run{args.run}.npz"
-    print("will save to",outpath)     
-    data = analyserun(runNR=args.run)
-    print("done", outpath)
-    np.savez_compressed(outpath,**data)
+    # all runs are analysed in this process (or the --jobs worker processes), so the imports,
+    # the dark files and the dark indices are loaded only once
+    runs = parse_runs(args.runs)
+    kwargs = dict(outdir=args.outdir, use_checkpoint=not args.no_checkpoint, workers=args.workers, mode=args.mode, use_pipeline=args.pipeline)
+    if args.jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            ok = list(pool.map(partial(analyse_and_save, **kwargs), runs))
+    else:
+        # the results of a run are written while the next one is analysed, one write at a time
+        pending = []
+        for run in runs:
+            pending.append(analyse_and_save(run, wait=False, previous=pending[-1] if pending else None, **kwargs))
+        ok = [p.result() for p in pending]
+    failed = [run for run, success in zip(runs, ok) if not success]
+    if failed:
+        print("failed runs:", *failed)
+        sys.exit(1)
@@ -0,0 +1,274 @@
+# felix zimmermann, github.com/fzimmermann89 for beamtime kuschel2023
+
+"""
+timings of the analysis on the real data, i.e.
+    python benchmark.py parallel 1234567 --max-shots 500 --workers 4
+and of the parts which do not need the data:
+    python benchmark.py imports
+    python benchmark.py droplets
+    python benchmark.py corrections
+    python benchmark.py codec
+    python benchmark.py binning
+"""
+
+import os
+import sys
+import time
+import subprocess
+import numpy as np
+
+# only imported when needed, should not be loaded by importing the analysis modules
+HEAVY_MODULES = ("dbpy", "stpy", "matplotlib", "scipy", "tqdm", "h5py")
+
+
+def timeit(func, *args, repeat=1, **kwargs):
+    """
+    best wall time of repeat calls of func(*args, **kwargs) in s
+    """
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_parallel(run, max_shots=500, workers=4, repeat=1):
+    """
+    analyserun serially, with a thread pool and with a process pool
+
+    Returns
+    -------
+    dict of mode: (time in s, shots per s)
+    """
+    import analyse
+
+    ret = {}
+    shots = []
+
+    def analyse_run(**kwargs):
+        # the number of good shots processed, at most max_shots
+        shots.append(len(analyse.analyserun(run, max_shots=max_shots, **kwargs)["tag"]))
+
+    for mode, w in (("serial", 1), ("thread", workers), ("process", workers)):
+        t = timeit(analyse_run, workers=w, mode="thread" if mode == "serial" else mode, repeat=repeat)
+        ret[mode] = (t, shots[-1] / t)
+        print(f"{mode:>8} ({w} workers): {t:.2f} s, {shots[-1]} shots, {shots[-1] / t:.1f} shots/s")
+    return ret
+
+
+def synthetic_photons(n_frames=10, shape=(1024, 1024), photons=1000, photon_energy=6400.0, noise=40.0, seed=0):
+    """
+    frames with gaussian noise and isolated photons, the charge of each shared between two neighbouring pixels
+
+    Returns
+    -------
+    frames in eV, number of photons per frame
+    """
+    rng = np.random.default_rng(seed)
+    frames = rng.normal(0, noise, (n_frames,) + tuple(shape)).astype(np.float32)
+    counts = np.zeros(n_frames, dtype=int)
+    for k in range(n_frames):
+        # on a grid, so no two photons touch
+        cells = rng.choice((shape[0] // 4) * (shape[1] // 4), size=photons, replace=False)
+        rows, cols = 4 * (cells // (shape[1] // 4)) + 1, 4 * (cells % (shape[1] // 4)) + 1
+        share = rng.uniform(0.5, 1, photons)
+        frames[k, rows, cols] += photon_energy * share
+        frames[k, rows, cols + 1] += photon_energy * (1 - share)
+        counts[k] = photons
+    return frames, counts
+
+
+def bench_droplets(n_frames=10, shape=(1024, 1024), photons=1000, batch=(1, 10), repeat=3):
+    """
+    droplet photon counting on synthetic frames, per frame and in stacks of batch frames
+    """
+    from droplets import DropletCounter
+
+    frames, counts = synthetic_photons(n_frames, shape, photons)
+    counter = DropletCounter(6400.0)
+    for b in batch:
+        def count():
+            return [counter(frames[i:i + b] if b > 1 else frames[i]) for i in range(0, n_frames, b)]
+
+        t = timeit(count, repeat=repeat)
+        found = sum(d.total for d in count())
+        print(f"batch {b:>3}: {t / n_frames * 1e3:.1f} ms/frame, {n_frames / t:.0f} frames/s, {found} of {counts.sum()} photons")
+
+
+def bench_corrections(n_frames=16, shape=(1024, 1024), batch=(1, 4, 16), panel_shape=(512, 1024), repeat=3):
+    """
+    per frame cost of the detector corrections (in place), per frame and in batches of (n, H, W)
+    """
+    from corrections import DetectorCorrection
+
+    rng = np.random.default_rng(0)
+    noise = 40  # ADU
+    frames = rng.normal(0, noise, (n_frames,) + tuple(shape)).astype(np.float32)
+    gain = rng.normal(1, 0.01, shape).astype(np.float32)
+    mask = rng.random(shape) < 0.001
+    corrections = {
+        "gain + mask": DetectorCorrection(gain=gain, mask=mask),
+        "row common mode": DetectorCorrection(common_mode="row"),
+        "panel common mode": DetectorCorrection(common_mode="panel", panel_shape=panel_shape),
+        "all, photons excluded": DetectorCorrection(gain=gain, mask=mask, common_mode="row", common_mode_threshold=5 * noise),  # in ADU
+    }
+    ret = {}
+    for name, correction in corrections.items():
+        for b in batch:
+            work = frames.copy()
+
+            def correct():
+                for i in range(0, n_frames, b):
+                    correction(work[i:i + b])
+
+            t = timeit(correct, repeat=repeat)
+            ret[name, b] = t / n_frames
+            print(f"{name:>22}, batch {b:>3}: {t / n_frames * 1e3:.1f} ms/frame")
+    return ret
+
+
+def bench_codec(n_frames=5, shape=(1024, 1024), repeat=3, path="benchmark_codec.npz"):
+    """
+    write and read time and file size of top-k like images (noise and photons, in ADU)
+    with np.savez_compressed and with codec.save for several codecs
+    """
+    import codec
+
+    frames, _ = synthetic_photons(n_frames, shape, photons=2000, photon_energy=1600.0, noise=10.0)
+    data = {"top_images": frames.astype(np.float64)}
+    variants = {"savez_compressed": None}
+    variants.update({repr(c): c for c in (codec.Codec("float32"), codec.Codec("float16"), codec.Codec("int", scale=1.0))})
+    ret = {}
+    try:
+        for name, c in variants.items():
+            if c is None:
+                def write():
+                    np.savez_compressed(path, **data)
+            else:
+                def write():
+                    codec.save(path, data, {"*": c})
+
+            def read():
+                with codec.load(path) as f:
+                    return f["top_images"]
+
+            t_write = timeit(write, repeat=repeat)
+            t_read = timeit(read, repeat=repeat)
+            size = os.path.getsize(path)
+            error = np.max(np.abs(read() - data["top_images"]))
+            ret[name] = (t_write, t_read, size)
+            print(f"{name:>32}: write {t_write * 1e3:.0f} ms, read {t_read * 1e3:.0f} ms, {size / 2 ** 20:.1f} MiB, max error {error:.2g}")
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    return ret
+
+
+def bench_binning(n_shots=2000, shape=(256, 256), nbins=10, batch=16, repeat=3):
+    """
+    binning images by a scan coordinate with accumulators.BinSorter (a Mean per bin, one shot at a time)
+    and with accumulators.ScanBinner (batches of shots), for shots in scan order and shuffled
+    """
+    import accumulators
+
+    rng = np.random.default_rng(0)
+    edges = np.linspace(0, 1, nbins + 1)
+    coords = np.sort(rng.uniform(0, 1, n_shots))
+    images = rng.normal(size=(n_shots,) + tuple(shape)).astype(np.float32)
+    ret = {}
+    for order, perm in (("scan order", np.arange(n_shots)), ("shuffled", rng.permutation(n_shots))):
+        c, v = coords[perm], images[perm]
+
+        def binsorter():
+            sorter = accumulators.BinSorter(edges, accumulators.Mean, key=lambda o: o[0], datakey=lambda o: o[1])
+            for shot in zip(c, v):
+                sorter.accumulate(shot)
+
+        def scanbinner():
+            binner = accumulators.ScanBinner(edges)
+            for start in range(0, n_shots, batch):
+                binner.add(c[start:start + batch], v[start:start + batch])
+
+        for name, func in (("BinSorter", binsorter), ("ScanBinner", scanbinner)):
+            t = timeit(func, repeat=repeat)
+            ret[name, order] = t
+            print(f"{name:>10}, {order:>10}: {t * 1e3:.0f} ms, {n_shots / t:.0f} shots/s")
+    return ret
+
+
+def import_times(module="analyse"):
+    """
+    import time of a module and all modules it imports in a fresh interpreter, using python -X importtime
+
+    Returns
+    -------
+    total time in s, dict of directly imported module: cumulative time in s, list of heavy modules that were loaded
+    """
+    code = f"import sys, {module}; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, (os.path.dirname(os.path.abspath(__file__)), os.environ.get("PYTHONPATH")))))
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, env=env, check=True)
+    total = 0
+    direct = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        total += int(self_us)
+        # indented by one space plus two per nesting level
+        if len(name) - len(name.lstrip()) == 3:
+            direct[name.strip()] = int(cumulative_us) / 1e6
+    heavy = [m for m in proc.stdout.strip().split(",") if m]
+    return total / 1e6, direct, heavy
+
+
+def bench_imports(modules=("analyse", "data_helper", "orchestrator", "aggregate"), repeat=5):
+    """
+    cold start import time of the analysis modules. fails if one of them loads a heavy module.
+    """
+    failed = False
+    for module in modules:
+        best, direct, heavy = min((import_times(module) for _ in range(repeat)), key=lambda t: t[0])
+        slowest = sorted(direct.items(), key=lambda t: -t[1])[:3]
+        print(f"{module:>12}: {best * 1e3:.0f} ms, slowest: " + ", ".join(f"{name} {t * 1e3:.0f} ms" for name, t in slowest))
+        if heavy:
+            print(f"{module:>12} imports {', '.join(heavy)}")
+            failed = True
+    return not failed
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="benchmarks of the analysis")
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+    p = sub.add_parser("parallel", help="analyserun serial vs threads vs processes")
+    p.add_argument("run", type=int)
+    p.add_argument("--max-shots", type=int, default=500)
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--repeat", type=int, default=1)
+    p = sub.add_parser("droplets", help="droplet photon counting on synthetic 1024x1024 frames")
+    p.add_argument("--frames", type=int, default=10)
+    p.add_argument("--photons", type=int, default=1000)
+    p = sub.add_parser("corrections", help="per frame cost of the detector corrections on synthetic 1024x1024 frames")
+    p.add_argument("--frames", type=int, default=16)
+    p = sub.add_parser("codec", help="writing and reading synthetic top-k images with np.savez_compressed and the codecs")
+    p.add_argument("--frames", type=int, default=5)
+    p = sub.add_parser("binning", help="binning synthetic 256x256 images by a scan coordinate, BinSorter vs ScanBinner")
+    p.add_argument("--shots", type=int, default=2000)
+    p = sub.add_parser("imports", help="import time of the analysis modules, checks that no heavy modules are loaded")
+    p.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.benchmark == "parallel":
+        bench_parallel(args.run, args.max_shots, args.workers, args.repeat)
+    elif args.benchmark == "droplets":
+        bench_droplets(args.frames, photons=args.photons)
+    elif args.benchmark == "corrections":
+        bench_corrections(args.frames)
+    elif args.benchmark == "codec":
+        bench_codec(args.frames)
+    elif args.benchmark == "binning":
+        bench_binning(args.shots)
+    elif args.benchmark == "imports":
+        sys.exit(0 if bench_imports(repeat=args.repeat) else 1)
@@ -2,6 +2,7 @@
 
 
 import numpy as np
+from sparse import SparseFrame, label_hits
 
 
 class topk():
@@ -27,10 +28,35 @@ class topk():
         if data is None:
             data = (value,)
         self._storage.append((value, data))
-        self._storage = sorted(self._storage, reverse=True)[:self._k]
+        self._storage = sorted(self._storage, key=lambda el: el[0], reverse=True)[:self._k]
 
     def get(self):
         return [el[1] for el in self._storage]
+
+    def merge(self, other):
+        """
+        add the elements of another topk
+        """
+        self._storage = sorted(self._storage + other._storage, key=lambda el: el[0], reverse=True)[:self._k]
+        return self
+
+    def state_dict(self):
+        """
+        the state as dict of numpy arrays. data has to be a tuple of stackable elements.
+        """
+        state = {"k": np.asarray(self._k), "values": np.array([el[0] for el in self._storage])}
+        if self._storage:
+            for j, field in enumerate(zip(*(el[1] for el in self._storage))):
+                state[f"data_{j}"] = np.stack(field)
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        ret = cls(int(state["k"]))
+        nfields = sum(1 for key in state if key.startswith("data_"))
+        fields = [state[f"data_{j}"] for j in range(nfields)]
+        ret._storage = [(value, tuple(field[i] for field in fields)) for i, value in enumerate(state["values"])]
+        return ret
     
 
 
@@ -80,4 +106,240 @@ class NoiseCutter():
     def __call__(self, image):
         ret = np.copy(image)
         ret[ret<self.threshold] = self.fill_value
-        return ret
\ No newline at end of file
+        return ret
+
+class Projection():
+    def __init__(self, axis=1, rows=None, cols=None, reduce="mean"):
+        """
+        Projects an image (or a stack of images in the last two axes) onto one axis
+        after cutting a rectangular roi.
+        Can be given to a Detector to only return the projection.
+
+        Parameters
+        ------
+        axis: image axis to reduce, i.e. 1 to get one value per row
+        rows: slice (or (start, stop)) of rows in the roi, None for all
+        cols: slice (or (start, stop)) of columns in the roi, None for all
+        reduce: "mean" or "sum"
+        """
+        if axis not in (0, 1):
+            raise ValueError("axis must be 0 or 1")
+        if reduce not in ("mean", "sum"):
+            raise ValueError("reduce must be 'mean' or 'sum'")
+        self.axis = axis
+        self.rows = rows if isinstance(rows, slice) else slice(*(rows or (None,)))
+        self.cols = cols if isinstance(cols, slice) else slice(*(cols or (None,)))
+        self.reduce = reduce
+
+    def __repr__(self):
+        return f"Projection({self.reduce} over axis {self.axis} of rows {self.rows}, cols {self.cols})"
+
+    def __call__(self, image, out=None):
+        image = np.asarray(image)
+        roi = image[..., self.rows, self.cols]
+        axis = image.ndim - 2 + self.axis
+        if self.reduce == "mean":
+            return np.mean(roi, axis=axis, out=out)
+        return np.sum(roi, axis=axis, out=out)
+
+
+class RadialProfile():
+    def __init__(self, center=None, os=1):
+        """
+        Radial profile of an image around center, as radial_profile.radial_profile.
+        The radii are calculated once per image shape, not for every image. nans are ignored.
+
+        Parameters
+        ------
+        center: center in pixels, None for the center of the image
+        os: oversampling, with 2 the radial stepsize is .5 pixels
+        """
+        self.center = center
+        self.os = os
+        self._shape = None
+        self._r = None
+
+    def _radii(self, shape):
+        if shape != self._shape:
+            center = np.array(shape) // 2 if self.center is None else np.asarray(self.center)
+            if len(center) != len(shape):
+                raise TypeError("center should be of length data.ndim")
+            ind = np.indices(shape)
+            center = center.reshape((-1,) + (1,) * len(shape))
+            self._r = np.rint(self.os * np.sqrt(((ind - center) ** 2).sum(axis=0))).astype(int).ravel()
+            self._shape = shape
+        return self._r
+
+    def __call__(self, image):
+        image = np.asarray(image)
+        r = self._radii(image.shape)
+        valid = ~np.isnan(image).ravel()
+        return np.bincount(r, np.where(valid, image.ravel(), 0)) / np.bincount(r, valid)
+
+
+class HitFinder():
+    def __init__(self, threshold=1000, cluster=False, connectivity=4):
+        """
+        Sparse hit finding: returns the pixels above threshold of a (dark corrected) image
+        or stack of images as a sparse.SparseFrame of flat indices and values.
+
+        Parameters
+        ------
+        threshold: pixels with larger values are hits, i.e. the NoiseCutter threshold
+        cluster: label connected hits (see sparse.label_hits), use frame.clusters() for per cluster values
+        connectivity: 4 or 8, for the labeling
+        """
+        self.threshold = threshold
+        self.cluster = cluster
+        self.connectivity = connectivity
+
+    def __call__(self, image):
+        image = np.asarray(image)
+        index = np.flatnonzero(image > self.threshold)
+        value = image.ravel()[index]
+        labels = label_hits(index, image.shape, self.connectivity) if self.cluster else None
+        return SparseFrame(index, value, image.shape, labels)
+
+
+def _polygon_mask(vertices, shape):
+    """
+    the pixels of an image of shape with their center inside the polygon (list of (row, col) vertices, even-odd rule)
+    """
+    vertices = np.asarray(vertices, dtype=float)
+    rows = np.arange(shape[0])[:, None]
+    cols = np.arange(shape[1])[None, :]
+    inside = np.zeros(shape, dtype=bool)
+    for (r0, c0), (r1, c1) in zip(vertices, np.roll(vertices, -1, axis=0)):
+        if r0 == r1:
+            continue
+        crosses = (r0 > rows) != (r1 > rows)
+        inside ^= crosses & (cols < c0 + (rows - r0) * (c1 - c0) / (r1 - r0))
+    return inside
+
+
+class ROI():
+    def __init__(self, rows=None, cols=None, rectangles=(), polygons=(), reduce="sum", low=-np.inf, high=np.inf):
+        """
+        Region of interest of an image: a rectangle, or the union of rectangles and polygons.
+        The region is computed once per image shape, as slices of its bounding box and, if it is not
+        a rectangle, the flat indices of its pixels in the box. sum, mean and count work on single images
+        and stacks (n, H, W) without a masked copy of the image. nans are not ignored.
+
+        Parameters
+        ------
+        rows, cols: slice (or (start, stop)) of a rectangle, None for all
+        rectangles: list of more (rows, cols) rectangles
+        polygons: list of polygons, each a list of (row, col) vertices. pixels with the center inside belong to it.
+        reduce: "sum", "mean" or "count", the value of calling the ROI (i.e. as pipeline stage)
+        low, high: count counts the pixels with low<value<high
+
+        Usage
+        ------
+        roi = ROI(rows=(270, 920), cols=(580, 1070))
+        roi.mean(side_mean)  # instead of np.nanmean(side_mean * nan_mask)
+        """
+        if reduce not in ("sum", "mean", "count"):
+            raise ValueError("reduce must be 'sum', 'mean' or 'count'")
+        rectangles = list(rectangles)
+        polygons = [np.asarray(p, dtype=float) for p in polygons]
+        if rows is not None or cols is not None or not (rectangles or polygons):
+            rectangles.insert(0, (rows, cols))
+        self.rectangles = [tuple(s if isinstance(s, slice) else slice(*(s or (None,))) for s in rect) for rect in rectangles]
+        self.polygons = polygons
+        self.reduce = reduce
+        self.low = low
+        self.high = high
+        self._shape = None
+
+    def __repr__(self):
+        return f"ROI({len(self.rectangles)} rectangles, {len(self.polygons)} polygons, {self.reduce})"
+
+    def _prepare(self, shape):
+        """
+        the bounding box slices, the flat indices in the box (None for a rectangle) and the number of pixels
+        """
+        shape = tuple(shape[-2:])
+        if shape == self._shape:
+            return
+        if len(self.rectangles) == 1 and not self.polygons:
+            rows, cols = self.rectangles[0]
+            if rows.step not in (None, 1) or cols.step not in (None, 1):
+                raise ValueError("the slices of a ROI can not have steps")
+            self._box = (slice(*rows.indices(shape[0])), slice(*cols.indices(shape[1])))
+            self._index = None
+            self._size = len(range(*rows.indices(shape[0]))) * len(range(*cols.indices(shape[1])))
+        else:
+            mask = self.mask(shape)
+            filled_rows, filled_cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+            if len(filled_rows) == 0:
+                self._box = (slice(0, 0), slice(0, 0))
+            else:
+                self._box = (slice(filled_rows[0], filled_rows[-1] + 1), slice(filled_cols[0], filled_cols[-1] + 1))
+            inbox = mask[self._box]
+            self._index = None if inbox.all() else np.flatnonzero(inbox)
+            self._size = int(inbox.sum())
+        self._shape = shape
+
+    def mask(self, shape):
+        """
+        boolean mask of the ROI for images of shape
+        """
+        shape = tuple(shape[-2:])
+        ret = np.zeros(shape, dtype=bool)
+        for rows, cols in self.rectangles:
+            ret[rows, cols] = True
+        for polygon in self.polygons:
+            ret |= _polygon_mask(polygon, shape)
+        return ret
+
+    def indices(self, shape):
+        """
+        flat indices of the ROI pixels in images of shape
+        """
+        return np.flatnonzero(self.mask(shape))
+
+    def size(self, shape):
+        """
+        number of pixels in the ROI for images of shape
+        """
+        self._prepare(shape)
+        return self._size
+
+    def values(self, image):
+        """
+        the values of the ROI pixels, shape (..., size)
+        """
+        image = np.asarray(image)
+        self._prepare(image.shape)
+        box = image[..., self._box[0], self._box[1]]
+        flat = box.reshape(box.shape[:-2] + (-1,))
+        return flat if self._index is None else flat[..., self._index]
+
+    def sum(self, image):
+        """
+        sum over the ROI of an image (or each image of a stack)
+        """
+        image = np.asarray(image)
+        self._prepare(image.shape)
+        if self._index is None:
+            return image[..., self._box[0], self._box[1]].sum(axis=(-2, -1))
+        return self.values(image).sum(axis=-1)
+
+    def mean(self, image):
+        """
+        mean over the ROI of an image (or each image of a stack), nan for an empty ROI
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.sum(image) / self.size(np.shape(image))
+
+    def count(self, image, low=None, high=None):
+        """
+        number of pixels with low<value<high (default: those of the ROI) in the ROI of an image (or each image of a stack)
+        """
+        low = self.low if low is None else low
+        high = self.high if high is None else high
+        values = self.values(image)
+        return np.count_nonzero((values > low) & (values < high), axis=-1)
+
+    def __call__(self, image):
+        return getattr(self, self.reduce)(image)
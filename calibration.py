@@ -0,0 +1,59 @@
+# felix zimmermann, github.com/fzimmermann89 for beamtime kuschel2023
+
+import numpy as np
+
+
+class CalibrationTable:
+    def __init__(self, raw, calibrated, mode="nearest", cache=False):
+        """
+        A lookup table to convert raw database values (e.g. motor pulses) to calibrated values.
+        Can be used as scalefunction in exp_config.database_keys.
+
+        Parameters
+        ----------
+        raw: raw values of the calibration points. need not be sorted.
+        calibrated: calibrated values at the calibration points
+        mode: "nearest" to return the value of the closest calibration point,
+              "linear" to interpolate linearly between calibration points (constant outside of the table)
+        cache: if True, the conversion is done only once per unique raw value.
+               useful if the values rarely change within a run, i.e. the attenuator.
+        """
+        raw = np.asarray(raw, dtype=float)
+        calibrated = np.asarray(calibrated, dtype=float)
+        if raw.ndim != 1 or raw.shape != calibrated.shape:
+            raise ValueError("raw and calibrated must be 1d arrays of the same length")
+        if len(raw) == 0:
+            raise ValueError("calibration table is empty")
+        if mode not in ("nearest", "linear"):
+            raise ValueError("mode must be 'nearest' or 'linear'")
+        order = np.argsort(raw, kind="stable")
+        self._raw = raw[order]
+        self._calibrated = calibrated[order]
+        # midpoints between neighbouring calibration points. a value belongs to the point right of the midpoints below it
+        self._midpoints = (self._raw[1:] + self._raw[:-1]) / 2
+        self.mode = mode
+        self.cache = cache
+
+    def __repr__(self):
+        return f"CalibrationTable with {len(self._raw)} points, mode {self.mode}"
+
+    def _convert(self, values):
+        if self.mode == "linear":
+            return np.interp(values, self._raw, self._calibrated)
+        # nearest: O(n log k) lookup against the midpoints, only the index array is allocated
+        idx = np.searchsorted(self._midpoints, values, side="left")
+        return np.take(self._calibrated, idx)
+
+    def __call__(self, values):
+        """
+        convert raw values (scalar or array) to calibrated values of the same shape
+        """
+        values = np.asarray(values, dtype=float)
+        if self.cache and values.ndim > 0 and values.size > 1:
+            unique, inverse = np.unique(values, return_inverse=True)
+            ret = self._convert(unique)[inverse].reshape(values.shape)
+        else:
+            ret = self._convert(values)
+        if values.ndim == 0:
+            return ret[()]
+        return ret
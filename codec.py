@@ -0,0 +1,431 @@
+# felix zimmermann, github.com/fzimmermann89 for beamtime kuschel2023
+
+"""
+Storage of large images (top-k and mean images) in the result files:
+reduced precision (float32, float16 or integers with a stored scale, i.e. ADU), byte shuffle
+and a fast compressor (zstd, lz4 or blosc if installed, zlib otherwise) in independent chunks.
+An encoded array is saved as several npz entries {key}/_codec/{part}; load and read_data_generator
+return a Results mapping that decodes them transparently, so results[key] is the image.
+ResultWriter writes the result files, encoding the fields in a thread pool.
+"""
+
+import io
+import os
+import time
+import zlib
+import zipfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+from pathlib import Path
+import numpy as np
+
+CODEC_TAG = "/_codec/"
+
+
+def _zstd():
+    import zstandard
+
+    return (lambda data, level: zstandard.ZstdCompressor(level=level or 3).compress(data), lambda data: zstandard.ZstdDecompressor().decompress(data))
+
+
+def _lz4():
+    import lz4.frame
+
+    return (lambda data, level: lz4.frame.compress(data, compression_level=level or 0), lz4.frame.decompress)
+
+
+def _blosc():
+    import blosc
+
+    # the bytes are already shuffled
+    return (lambda data, level: blosc.compress(data, typesize=1, clevel=level or 5, shuffle=blosc.NOSHUFFLE, cname="lz4"), blosc.decompress)
+
+
+def _zlib():
+    return (lambda data, level: zlib.compress(data, 1 if level is None else level), zlib.decompress)
+
+
+# name: loader of (compress(bytes, level), decompress(bytes)), in order of preference for compressor="auto"
+COMPRESSORS = {"zstd": _zstd, "lz4": _lz4, "blosc": _blosc, "zlib": _zlib, "none": lambda: (lambda data, level: data, bytes)}
+_loaded = {}
+
+
+def compressor(name):
+    """
+    (compress, decompress) functions of a compressor by name. "auto" is the fastest installed one.
+
+    Returns
+    -------
+    name, compress, decompress
+    """
+    if name == "auto":
+        for candidate in COMPRESSORS:
+            try:
+                return compressor(candidate)
+            except ImportError:
+                continue
+    if name not in _loaded:
+        if name not in COMPRESSORS:
+            raise ValueError(f"unknown compressor {name}, use one of {', '.join(COMPRESSORS)} or auto")
+        _loaded[name] = COMPRESSORS[name]()
+    return (name,) + _loaded[name]
+
+
+def shuffle(data):
+    """
+    byte shuffle: the first bytes of all elements, then the second bytes, ...
+    the slowly varying high bytes of images then compress much better
+    """
+    data = np.ascontiguousarray(data).reshape(-1)
+    return data.view(np.uint8).reshape(len(data), data.itemsize).T.copy()
+
+
+def unshuffle(data, dtype):
+    """
+    inverse of shuffle for the bytes data of elements of dtype
+    """
+    dtype = np.dtype(dtype)
+    return np.ascontiguousarray(np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, -1).T).view(dtype).reshape(-1)
+
+
+class Codec:
+    def __init__(self, dtype="float32", scale=None, compressor="auto", level=None, shuffle=True, chunk_bytes=1 << 20):
+        """
+        Encoding of an array for storage.
+
+        Parameters
+        ----------
+        dtype: stored precision, "float32", "float16" or "int" for integers of value/scale,
+            i.e. ADU for scale=1 and images in ADU. "int" uses int16 or int32, whichever fits; nans are kept.
+            None keeps the dtype (lossless)
+        scale: quantization step for dtype="int". None: the largest value is mapped to the int16 range
+        compressor: one of COMPRESSORS or "auto" for the fastest installed
+        level: compression level, None for the default of the compressor (fast)
+        shuffle: byte shuffle before the compression
+        chunk_bytes: size of the independently compressed chunks
+        """
+        if dtype not in ("float32", "float16", "int", None):
+            raise ValueError("dtype must be 'float32', 'float16', 'int' or None")
+        self.dtype = dtype
+        self.scale = scale
+        self.compressor = compressor
+        self.level = level
+        self.shuffle = shuffle
+        self.chunk_bytes = chunk_bytes
+
+    def __repr__(self):
+        scale = f", scale {self.scale}" if self.dtype == "int" else ""
+        return f"Codec ({self.dtype or 'lossless'}{scale}, {self.compressor})"
+
+    def _quantize(self, array):
+        """
+        the array in the stored dtype and the scale
+        """
+        if self.dtype is None:
+            return array, 1.0
+        if self.dtype != "int":
+            stored = array.astype(self.dtype)
+            if self.dtype == "float16" and np.isinf(stored).any() and not np.isinf(array).any():
+                raise ValueError("values exceed the float16 range, use float32 or int")
+            return stored, 1.0
+        finite = np.isfinite(array)
+        largest = float(np.abs(array[finite]).max()) if finite.any() else 0.0
+        scale = self.scale if self.scale is not None else (largest / 32766 or 1.0)
+        # the smallest value of the integer type marks nans
+        dtype = np.int16 if largest / scale < 32766 else np.int32
+        if largest / scale >= np.iinfo(np.int32).max - 1:
+            raise ValueError(f"values exceed the int32 range with scale {scale}")
+        stored = np.rint(array / scale)
+        stored[~finite] = np.iinfo(dtype).min
+        return stored.astype(dtype), float(scale)
+
+    def encode(self, array, map=map):
+        """
+        encode an array, the chunks are compressed with map (i.e. the map of a thread pool)
+
+        Returns
+        -------
+        dict of part: array, see decode
+        """
+        array = np.asarray(array)
+        if not np.issubdtype(array.dtype, np.number) or np.iscomplexobj(array):
+            raise TypeError(f"only real numeric arrays can be encoded, not {array.dtype}")
+        stored, scale = self._quantize(array)
+        name, compress, _ = compressor(self.compressor)
+        flat = stored.reshape(-1)
+        step = max(self.chunk_bytes // stored.itemsize, 1)
+
+        def compress_chunk(start):
+            chunk = flat[start:start + step]
+            return compress((shuffle(chunk) if self.shuffle else chunk).tobytes(), self.level)
+
+        chunks = list(map(compress_chunk, range(0, max(len(flat), 1), step)))
+        return {
+            "data": np.frombuffer(b"".join(chunks), dtype=np.uint8),
+            "offsets": np.cumsum([0] + [len(c) for c in chunks], dtype=np.int64),
+            "shape": np.asarray(array.shape, dtype=np.int64),
+            "dtype": np.asarray(array.dtype.str.encode()),
+            "stored": np.asarray(stored.dtype.str.encode()),
+            "scale": np.asarray(scale),
+            "compressor": np.asarray(name.encode()),
+            "shuffle": np.asarray(self.shuffle),
+        }
+
+
+def decode(parts):
+    """
+    decode the parts returned by Codec.encode (or read from a file) to the array
+    """
+    _, _, decompress = compressor(parts["compressor"][()].decode())
+    stored = np.dtype(parts["stored"][()].decode())
+    dtype = np.dtype(parts["dtype"][()].decode())
+    data = parts["data"]
+    offsets = parts["offsets"]
+    flat = np.empty(int(np.prod(parts["shape"])), dtype=stored)
+    start = 0
+    for begin, end in zip(offsets[:-1], offsets[1:]):
+        raw = decompress(data[begin:end].tobytes())
+        chunk = unshuffle(raw, stored) if parts["shuffle"][()] else np.frombuffer(raw, dtype=stored)
+        flat[start:start + len(chunk)] = chunk
+        start += len(chunk)
+    scale = parts["scale"][()]
+    if stored.kind == "i" and dtype.kind == "f":
+        ret = flat.astype(dtype)
+        ret[flat == np.iinfo(stored).min] = np.nan
+        ret *= scale
+    elif stored.kind == "i" and scale != 1:
+        ret = np.rint(flat * scale).astype(dtype)
+    else:
+        ret = flat.astype(dtype, copy=False)
+    return ret.reshape(tuple(parts["shape"]))
+
+
+def codec_for(key, codecs):
+    """
+    the Codec of the first matching (fnmatch) pattern in the dict codecs, or None
+    """
+    for pattern, codec in (codecs or {}).items():
+        if fnmatchcase(key, pattern):
+            return codec
+    return None
+
+
+# shuffle and compression only, for the large fields without a codec
+LOSSLESS = Codec(None)
+
+
+def _npy(value):
+    """
+    an array in the .npy format as bytes
+    """
+    f = io.BytesIO()
+    np.lib.format.write_array(f, np.asanyarray(value), allow_pickle=False)
+    return f.getvalue()
+
+
+class ResultWriter:
+    def __init__(self, path, codecs=None, workers=4, default_codec=LOSSLESS, min_bytes=1 << 16):
+        """
+        Writes results to an npz file that np.load can read, with the fields encoded and compressed
+        in a thread pool. A field is written as soon as it is encoded, so small fields (i.e. per shot values)
+        are written while the images are still encoded. The file is written to a temporary file and
+        renamed on close, i.e. it is either complete or not there.
+
+        Parameters
+        ----------
+        path: result file
+        codecs: dict of fnmatch pattern of the key: Codec, i.e. exp_config.result_codecs
+        workers: number of threads
+        default_codec: Codec of the numeric arrays not matching codecs and larger than min_bytes,
+            None to zip compress them like np.savez_compressed (single threaded)
+
+        Usage
+        ------
+        with ResultWriter(path, codecs) as writer:
+            writer.update(data)
+            writer.add("forward_mean", image)
+        or writer.close(wait=False) to finish the writing in the background
+        """
+        self.path = Path(path)
+        self.codecs = codecs
+        self.default_codec = default_codec
+        self.min_bytes = min_bytes
+        self._tmpfile = self.path.with_name(f".{self.path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        self._zip = zipfile.ZipFile(self._tmpfile, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(workers)
+        # the chunks of a field are compressed in a second pool, the field tasks wait for them
+        self._chunks = ThreadPoolExecutor(workers)
+        self._futures = []
+        self._keys = set()
+        self._closed = False
+
+    def __repr__(self):
+        return f"ResultWriter for {self.path}, {len(self._keys)} fields"
+
+    def _codec(self, key, value):
+        if not np.issubdtype(value.dtype, np.number) or np.iscomplexobj(value) or value.size == 0:
+            return None
+        codec = codec_for(key, self.codecs)
+        if codec is not None and np.issubdtype(value.dtype, np.floating):
+            return codec
+        if value.nbytes >= self.min_bytes:
+            return self.default_codec
+        return None
+
+    def _write(self, key, value):
+        value = np.asanyarray(value)
+        codec = self._codec(key, value)
+        if codec is None:
+            entries = [(key, _npy(value), zipfile.ZIP_DEFLATED)]
+        else:
+            parts = codec.encode(value, map=self._chunks.map)
+            entries = [(f"{key}{CODEC_TAG}{part}", _npy(item), zipfile.ZIP_STORED) for part, item in parts.items()]
+        for name, data, compress_type in entries:
+            info = zipfile.ZipInfo(f"{name}.npy", date_time=time.localtime()[:6])
+            info.compress_type = compress_type
+            with self._lock:
+                self._zip.writestr(info, data)
+
+    def add(self, key, value):
+        """
+        add a field, it is encoded and written in the background
+        """
+        if self._closed:
+            raise ValueError("the writer is closed")
+        if key in self._keys:
+            raise ValueError(f"{key} was already added")
+        self._keys.add(key)
+        self._futures.append(self._pool.submit(self._write, key, value))
+
+    def update(self, data):
+        """
+        add all fields of the dict data
+        """
+        for key, value in data.items():
+            self.add(key, value)
+
+    def _finish(self):
+        try:
+            for future in self._futures:
+                future.result()
+            self._zip.close()
+            os.replace(self._tmpfile, self.path)
+        except BaseException:
+            self._discard()
+            raise
+        finally:
+            self._chunks.shutdown(wait=False)
+            self._pool.shutdown(wait=False)
+        return self.path
+
+    def _discard(self):
+        for future in self._futures:
+            future.cancel()
+        self._zip.close()
+        if self._tmpfile.exists():
+            self._tmpfile.unlink()
+
+    def close(self, wait=True):
+        """
+        wait for all fields and rename the file to path.
+        if not wait, this happens in the background and a Future of the path is returned.
+        """
+        self._closed = True
+        if wait:
+            return self._finish()
+        # all field tasks were submitted before, so they are running or done when this one starts
+        return self._pool.submit(self._finish)
+
+    def abort(self):
+        """
+        stop writing and remove the temporary file
+        """
+        self._closed = True
+        try:
+            self._discard()
+        finally:
+            self._chunks.shutdown(wait=False)
+            self._pool.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def save(path, data, codecs=None, workers=4):
+    """
+    atomically write data (dict of arrays) to an npz file that np.load can read,
+    with the arrays matching codecs (dict of fnmatch pattern: Codec) encoded, see ResultWriter
+    """
+    with ResultWriter(path, codecs, workers) as writer:
+        writer.update(data)
+    return Path(path)
+
+
+class Results:
+    def __init__(self, npz):
+        """
+        Read only mapping of the entries of a result file (an NpzFile), encoded arrays are decoded on access.
+        Has files, keys(), [key], close() and can be used as context manager like the NpzFile.
+        """
+        self._npz = npz
+        self.files = []
+        self._encoded = {}
+        for key in npz.files:
+            if CODEC_TAG in key:
+                name, part = key.split(CODEC_TAG, 1)
+                if name not in self._encoded:
+                    self._encoded[name] = {}
+                    self.files.append(name)
+                self._encoded[name][part] = key
+            else:
+                self.files.append(key)
+
+    def __getitem__(self, key):
+        if key in self._encoded:
+            return decode({part: self._npz[entry] for part, entry in self._encoded[key].items()})
+        return self._npz[key]
+
+    def __contains__(self, key):
+        return key in self._encoded or key in self._npz.files
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __len__(self):
+        return len(self.files)
+
+    def keys(self):
+        return list(self.files)
+
+    def items(self):
+        return [(key, self[key]) for key in self.files]
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def close(self):
+        self._npz.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return f"Results ({len(self.files)} entries, {len(self._encoded)} encoded)"
+
+
+def load(path):
+    """
+    open a result file written by save (or np.savez), see Results
+    """
+    return Results(np.load(path))
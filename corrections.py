@@ -0,0 +1,100 @@
+# felix zimmermann, github.com/fzimmermann89 for beamtime kuschel2023
+
+import numpy as np
+
+
+def _median(groups):
+    """
+    median along the last axis ignoring nans, nan for groups without values.
+    the vectorized sort is faster than np.median / np.nanmedian on float32 rows.
+    """
+    ordered = np.sort(groups, axis=-1)  # nans last
+    n = np.count_nonzero(~np.isnan(groups), axis=-1)
+    low = np.take_along_axis(ordered, np.maximum((n - 1) // 2, 0)[..., None], axis=-1)[..., 0]
+    high = np.take_along_axis(ordered, np.minimum(n // 2, groups.shape[-1] - 1)[..., None], axis=-1)[..., 0]
+    return np.where(n > 0, (low + high) / 2, np.nan)
+
+
+class DetectorCorrection:
+    def __init__(self, gain=None, mask=None, common_mode=None, panel_shape=None, common_mode_threshold=None, fill_value=0.0):
+        """
+        Corrections of dark subtracted MPCCD frames, applied in place to a frame or a stack (n, H, W) of frames:
+        common mode subtraction, pixel gain map and bad pixel mask, in this order.
+        Can be given to a Detector, which applies it after the dark subtraction and before projection and ev conversion.
+
+        Parameters
+        ----------
+        gain: None or relative gain per pixel (H, W), the frames are multiplied by it
+        mask: None or bad pixels (H, W), nonzero is bad (i.e. the bitmask of darks.DarkAccumulator).
+            bad pixels are ignored for the common mode and set to fill_value
+        common_mode: None, "row" or "panel". the median of each row (or panel) is subtracted
+        panel_shape: (rows, cols) of a panel, for common_mode="panel"
+        common_mode_threshold: pixels above (i.e. photons) are ignored for the common mode. in ADU, as the
+            corrections are applied before the ev conversion (divide a threshold in eV by the detector's ev_per_adu)
+        fill_value: value of bad pixels, i.e. 0 or np.nan
+        """
+        if common_mode not in (None, "row", "panel"):
+            raise ValueError("common_mode must be None, 'row' or 'panel'")
+        if common_mode == "panel" and panel_shape is None:
+            raise ValueError("common_mode='panel' needs the panel_shape")
+        self.gain = None if gain is None else np.asarray(gain, dtype=np.float32)
+        self.mask = None if mask is None else np.asarray(mask) != 0
+        self.common_mode = common_mode
+        self.panel_shape = None if panel_shape is None else tuple(panel_shape)
+        self.common_mode_threshold = common_mode_threshold
+        self.fill_value = fill_value
+
+    def __repr__(self):
+        parts = [name for name, used in (("gain", self.gain is not None), ("mask", self.mask is not None), (f"{self.common_mode} common mode", self.common_mode)) if used]
+        return f"DetectorCorrection ({', '.join(parts) or 'nothing'})"
+
+    def _groups(self, frames):
+        """
+        frames with the pixels of each common mode group in the last axis (a copy for panels)
+        """
+        if self.common_mode == "row":
+            return frames
+        *lead, h, w = frames.shape
+        ph, pw = self.panel_shape
+        if h % ph or w % pw:
+            raise ValueError(f"frame shape {(h, w)} is not a multiple of the panel shape {self.panel_shape}")
+        panels = frames.reshape(tuple(lead) + (h // ph, ph, w // pw, pw)).swapaxes(-3, -2)
+        return panels.reshape(tuple(lead) + (h // ph, w // pw, ph * pw))
+
+    def common_mode_offsets(self, frames):
+        """
+        the median of each row or panel of frames, ignoring bad pixels and pixels above the threshold
+        """
+        exclude = None
+        if self.mask is not None:
+            exclude = np.broadcast_to(self.mask, frames.shape)
+        if self.common_mode_threshold is not None:
+            above = frames > self.common_mode_threshold
+            exclude = above if exclude is None else exclude | above
+        groups = self._groups(frames if exclude is None else np.where(exclude, np.float32(np.nan), frames))
+        # groups without any good pixel are not corrected
+        return np.nan_to_num(_median(groups), copy=False)
+
+    def __call__(self, frames):
+        """
+        correct frames (float array, last two axes are the image axes) in place
+
+        Returns
+        -------
+        frames
+        """
+        if not np.issubdtype(frames.dtype, np.floating):
+            raise TypeError("frames must be a float array to be corrected in place")
+        if self.common_mode is not None:
+            offsets = self.common_mode_offsets(frames)
+            if self.common_mode == "row":
+                frames -= offsets[..., None]
+            else:
+                ph, pw = self.panel_shape
+                frames -= np.repeat(np.repeat(offsets, ph, axis=-2), pw, axis=-1)
+        if self.gain is not None:
+            frames *= self.gain
+        if self.mask is not None:
+            frames[..., self.mask] = self.fill_value
+        return frames
+
@@ -0,0 +1,430 @@
+# felix zimmermann, github.com/fzimmermann89 for beamtime kuschel2023
+
+import os
+import numpy as np
+from pathlib import Path
+from functools import lru_cache
+import accumulators
+
+INDEX_FILENAME = "darkindex.npz"
+_indices = {}
+
+
+def _time_from_filename(file):
+    """
+    darkfiles are named *_{timestamp}.np?
+    returns the timestamp or None
+    """
+    try:
+        return float(Path(file).stem.split("_")[-1])
+    except (ValueError, IndexError):
+        return None
+
+
+class DarkIndex:
+    def __init__(self, path):
+        """
+        Index of the darkfiles in a folder, sorted by their timestamp.
+        darkfiles have to be named *_{timestamp}.np?
+
+        The index is persisted as darkindex.npz in the folder and only rebuilt if the folder
+        has been modified after the index was written. Files added in subfolders are only
+        picked up by refresh() or add().
+        Use DarkIndex.get(path) to share one index per folder within the process, it is
+        reloaded if the folder has been modified since (see update).
+
+        Parameters
+        ----------
+        path: folder containing the darkfiles
+        """
+        self.path = Path(path)
+        self.times = np.zeros(0)
+        self.files = np.zeros(0, dtype=str)
+        self._mtime = None
+        self.update()
+
+    @classmethod
+    def get(cls, path):
+        """
+        the shared index of a folder
+        """
+        path = Path(path).resolve()
+        if path not in _indices:
+            _indices[path] = cls(path)
+        else:
+            _indices[path].update()
+        return _indices[path]
+
+    def __len__(self):
+        return len(self.times)
+
+    def __repr__(self):
+        return f"DarkIndex of {len(self)} darkfiles in {self.path}"
+
+    @property
+    def _indexfile(self):
+        return self.path / INDEX_FILENAME
+
+    def _folder_mtime(self):
+        try:
+            return self.path.stat().st_mtime
+        except OSError:
+            return None
+
+    def update(self):
+        """
+        reload (or rebuild) the index if the folder has been modified since it was read
+        """
+        mtime = self._folder_mtime()
+        if self._mtime is not None and mtime == self._mtime:
+            return
+        if not self._load():
+            self.refresh()
+        # the time before reading, so changes while reading are picked up by the next update
+        self._mtime = mtime
+
+    def _load(self):
+        try:
+            if self._indexfile.stat().st_mtime < self.path.stat().st_mtime:
+                return False
+            with np.load(self._indexfile) as f:
+                self.times, self.files = f["times"], f["files"]
+        except (OSError, KeyError, ValueError):
+            return False
+        return True
+
+    def _save(self):
+        tmpfile = self.path / f".{INDEX_FILENAME}.{os.getpid()}.tmp"
+        try:
+            with open(tmpfile, "wb") as f:
+                np.savez(f, times=self.times, files=self.files)
+            os.replace(tmpfile, self._indexfile)
+            # the rename modified the folder, mark the index as newer
+            os.utime(self._indexfile)
+        except OSError:
+            # read only folder. the index is still used in memory.
+            try:
+                tmpfile.unlink()
+            except OSError:
+                pass
+
+    def _set(self, times, files):
+        order = np.argsort(times, kind="stable")
+        self.times = np.asarray(times, dtype=float)[order]
+        self.files = np.asarray(files, dtype=str)[order]
+
+    def refresh(self):
+        """
+        rescan the folder and persist the index
+        """
+        self._mtime = self._folder_mtime()
+        times, files = [], []
+        for file in self.path.rglob("*_*.np?"):
+            time = _time_from_filename(file)
+            if time is None:
+                continue
+            times.append(time)
+            files.append(str(file.relative_to(self.path)))
+        self._set(times, files)
+        self._save()
+
+    def add(self, file):
+        """
+        add a new darkfile to the index and persist the index
+        """
+        file = Path(file)
+        time = _time_from_filename(file)
+        if time is None:
+            raise ValueError(f"{file} is not named *_{{timestamp}}.np?")
+        relative = str(file.resolve().relative_to(self.path))
+        keep = self.files != relative
+        self._set(np.append(self.times[keep], time), np.append(self.files[keep], relative))
+        self._save()
+
+    def closest(self, time):
+        """
+        returns the path of the darkfile with timestamp closest to time or None if the index is empty
+        """
+        if len(self.times) == 0:
+            return None
+        i = int(np.searchsorted(self.times, time))
+        if i == len(self.times) or (i > 0 and time - self.times[i - 1] <= self.times[i] - time):
+            i -= 1
+        return self.path / self.files[i]
+
+
+@lru_cache(maxsize=16)
+def load_dark(filename):
+    """
+    loads a darkfile memory mapped and read only.
+    the same array is returned for the same file within the process, i.e. shared between detectors and runs.
+    """
+    dark = np.load(filename, mmap_mode="r")
+    if isinstance(dark, np.lib.npyio.NpzFile):
+        with dark:
+            dark = dark[dark.files[0]]
+        dark.setflags(write=False)
+    return dark
+
+
+##### Creation of darks ######
+
+HOT = 1
+DEAD = 2
+NOISY = 4
+
+
+class DarkAccumulator(accumulators.Accumulator):
+    def __init__(self, clip_sigma=5.0):
+        """
+        Accumulates dark frames (single frames or stacks of shape (n, H, W)) in a single pass.
+
+        Tracks the mean and variance (Welford, merged per stack) and a robust pedestal:
+        in each stack, values further than clip_sigma robust standard deviations (1.4826 * MAD)
+        from the per pixel median of the stack are rejected, the remaining values are averaged.
+        Single frames are not clipped, so use stacks of at least a few frames.
+
+        value is the robust pedestal.
+        """
+        self.clip_sigma = clip_sigma
+        self.variance = accumulators.Variance()
+        self._clipped_sum = 0.
+        self._clipped_sumsq = 0.
+        self._clipped_n = 0
+
+    def _accumulate_obj(self, obj):
+        frames = np.asarray(obj, dtype=float)
+        if frames.ndim == 2:
+            frames = frames[None]
+        n = len(frames)
+        if n == 0:
+            return
+        stack = accumulators.Variance()
+        stack.mean = accumulators.Mean(value=frames.mean(axis=0), n=n)
+        stack.var = accumulators.Mean(value=frames.var(axis=0), n=n)
+        if self.n == 0:
+            self.variance = stack
+        else:
+            self.variance.accumulate(stack)
+
+        if n > 2:
+            median = np.median(frames, axis=0)
+            deviation = np.abs(frames - median)
+            sigma = 1.4826 * np.median(deviation, axis=0)
+            good = deviation <= self.clip_sigma * sigma
+        else:
+            good = np.ones(frames.shape, dtype=bool)
+        self._clipped_sum = self._clipped_sum + np.sum(frames, axis=0, where=good)
+        self._clipped_sumsq = self._clipped_sumsq + np.sum(frames ** 2, axis=0, where=good)
+        self._clipped_n = self._clipped_n + np.count_nonzero(good, axis=0)
+
+    def _accumulate_other(self, other):
+        if other.n == 0:
+            return
+        if self.n == 0:
+            self.variance = other.variance
+        else:
+            self.variance.accumulate(other.variance)
+        self._clipped_sum = self._clipped_sum + other._clipped_sum
+        self._clipped_sumsq = self._clipped_sumsq + other._clipped_sumsq
+        self._clipped_n = self._clipped_n + other._clipped_n
+
+    @property
+    def n(self):
+        return self.variance.n
+
+    @property
+    def mean(self):
+        return self.variance.mean.value
+
+    @property
+    def std(self):
+        return self.variance.std
+
+    @property
+    def value(self):
+        if self.n == 0:
+            raise ValueError("no dark frames accumulated")
+        with np.errstate(invalid="ignore", divide="ignore"):
+            pedestal = self._clipped_sum / self._clipped_n
+        # pixels where all values were rejected fall back to the mean
+        return np.where(self._clipped_n > 0, pedestal, self.mean)
+
+    @property
+    def robust_std(self):
+        """
+        standard deviation of the values not rejected as outliers
+        """
+        if self.n < 2:
+            raise ValueError(f"the standard deviation needs at least 2 dark frames, {self.n} accumulated")
+        with np.errstate(invalid="ignore", divide="ignore"):
+            var = (self._clipped_sumsq - self._clipped_sum ** 2 / self._clipped_n) / (self._clipped_n - 1)
+        return np.where(self._clipped_n > 1, np.sqrt(np.maximum(var, 0)), self.std)
+
+    def bad_pixel_mask(self, hot_sigma=10.0, noisy_factor=5.0, dead_factor=0.1):
+        """
+        Bitmask of bad pixels (0 is good)
+            HOT: pedestal deviates by more than hot_sigma robust standard deviations from the median pedestal
+            NOISY: robust standard deviation above noisy_factor times the median robust standard deviation
+            DEAD: robust standard deviation below dead_factor times the median robust standard deviation
+        """
+        pedestal = self.value
+        std = self.robust_std
+        center = np.median(pedestal)
+        spread = 1.4826 * np.median(np.abs(pedestal - center))
+        median_std = np.median(std)
+        mask = np.zeros(np.shape(pedestal), dtype=np.uint8)
+        mask[np.abs(pedestal - center) > hot_sigma * spread] |= HOT
+        mask[std > noisy_factor * median_std] |= NOISY
+        mask[std < dead_factor * median_std] |= DEAD
+        return mask
+
+    def _state(self):
+        return {
+            "clip_sigma": np.asarray(self.clip_sigma),
+            "clipped_sum": np.asarray(self._clipped_sum),
+            "clipped_sumsq": np.asarray(self._clipped_sumsq),
+            "clipped_n": np.asarray(self._clipped_n),
+            **accumulators.prefix_state(self.variance.state_dict(), "variance."),
+        }
+
+    @classmethod
+    def _from_state(cls, state):
+        ret = cls(clip_sigma=float(state["clip_sigma"]))
+        ret.variance = accumulators.Accumulator.from_state(accumulators.sub_state(state, "variance."))
+        ret._clipped_sum = state["clipped_sum"]
+        ret._clipped_sumsq = state["clipped_sumsq"]
+        ret._clipped_n = state["clipped_n"]
+        return ret
+
+
+def _accumulate_dark_chunk(detID, bl, run, indices, batchsize, clip_sigma):
+    """
+    reads the frames at indices of a run in batches into a DarkAccumulator.
+    runs in the worker processes.
+    """
+    from data_helper import Detector
+
+    det = Detector(detID, bl=bl, run=run, dark=None, ev_per_adu=1.0)
+    acc = DarkAccumulator(clip_sigma=clip_sigma)
+    for start in range(0, len(indices), batchsize):
+        acc.accumulate(np.stack([det[i] for i in indices[start:start + batchsize]]))
+    return acc
+
+
+def _chunk_info(chunk, batchsize, clip_sigma):
+    """
+    the shot index range of a chunk and the settings its accumulated state depends on
+    """
+    start = chunk[0] if len(chunk) else 0
+    return np.array([start, start + len(chunk), batchsize, clip_sigma], dtype=float)
+
+
+def _save_partial(filename, acc, info):
+    """
+    saves the state of a chunk with its _chunk_info
+    """
+    np.savez(filename, chunk=info, **acc.state_dict())
+
+
+def _partial_matches(filename, info):
+    """
+    True if the partial state of a chunk exists and was accumulated with the same _chunk_info
+    """
+    try:
+        with np.load(filename) as f:
+            return "chunk" in f.files and np.array_equal(f["chunk"], info)
+    except (OSError, ValueError):
+        return False
+
+
+def create_darks(runs, detector_keys=None, detector_dark_paths=None, bl=3, workers=4, batchsize=32, clip_sigma=5.0, max_shots=None):
+    """
+    Creates darkfiles from dark runs.
+
+    For each run and detector the frames are read in batches by a pool of processes,
+    and the robust pedestal (in ADU), the standard deviation and a bad pixel mask are written to
+    {run}_{timestamp}.npy, {run}_{timestamp}_std.npy (robust) and {run}_{timestamp}_mask.npy
+    in the detector's dark folder. timestamp is the middle of the dark run. The DarkIndex of the folder is updated.
+
+    Finished darks are skipped and the accumulated state of each chunk is kept in a .partial subfolder
+    until the dark is written, so an interrupted call can be resumed by calling it again.
+    A partial is only used if it is of the same shots, batchsize and clip_sigma, otherwise the chunk is read again.
+
+    Parameters
+    ----------
+    runs: run number or list of run numbers
+    detector_keys: dict of name:sacla_internal_name. default exp_config.detector_keys
+    detector_dark_paths: dict of name:folder to write the darks to. detectors without folder are skipped.
+                         default exp_config.detector_dark_paths
+    bl: beamline
+    workers: number of processes used for reading
+    batchsize: number of frames per batch. the outlier rejection is done per batch.
+    clip_sigma: outlier rejection threshold in robust standard deviations
+    max_shots: use at most this many shots per run
+
+    Returns
+    -------
+    list of written darkfiles. runs with less than 2 frames are skipped
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from data_helper import getTags, getRunCenterTime
+    import exp_config
+
+    if detector_keys is None:
+        detector_keys = exp_config.detector_keys
+    if detector_dark_paths is None:
+        detector_dark_paths = exp_config.detector_dark_paths
+    if np.ndim(runs) == 0:
+        runs = [runs]
+    written = []
+    folders = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for run in runs:
+            run = int(run)
+            time = int(getRunCenterTime(bl, run))
+            nshots = len(getTags(bl, run=run))
+            if max_shots is not None:
+                nshots = min(nshots, max_shots)
+            chunks = np.array_split(np.arange(nshots), max(1, min(workers, nshots // batchsize)))
+            for name, detID in detector_keys.items():
+                if detector_dark_paths.get(name) is None:
+                    continue
+                folder = Path(detector_dark_paths[name])
+                if folders.setdefault(folder.resolve(), name) != name:
+                    print(f"{name} shares the dark folder {folder} with {folders[folder.resolve()]}, skipping")
+                    continue
+                darkfile = folder / f"{run}_{time}.npy"
+                if darkfile.exists():
+                    print(f"dark {darkfile} exists, skipping")
+                    continue
+                partialfolder = folder / ".partial"
+                partialfolder.mkdir(parents=True, exist_ok=True)
+                partials = [partialfolder / f"{run}_{name}_chunk{i}.npz" for i in range(len(chunks))]
+                infos = [_chunk_info(chunk, batchsize, clip_sigma) for chunk in chunks]
+                futures = {
+                    i: pool.submit(_accumulate_dark_chunk, detID, bl, run, chunk, batchsize, clip_sigma)
+                    for i, (chunk, partial, info) in enumerate(zip(chunks, partials, infos))
+                    if not _partial_matches(partial, info)
+                }
+                acc = DarkAccumulator(clip_sigma=clip_sigma)
+                for i, partial in enumerate(partials):
+                    if i in futures:
+                        _save_partial(partial, futures[i].result(), infos[i])
+                    acc.accumulate(accumulators.load_state(partial))
+                if acc.n < 2:
+                    print(f"run {run} has {acc.n} dark frames of {name}, at least 2 are needed, skipping")
+                    continue
+                np.save(folder / f"{run}_{time}_std.npy", acc.robust_std)
+                np.save(folder / f"{run}_{time}_mask.npy", acc.bad_pixel_mask())
+                # write the dark last and atomically, its existence marks the run as finished
+                tmpfile = folder / f".{run}_{time}.npy.tmp"
+                with open(tmpfile, "wb") as f:
+                    np.save(f, acc.value)
+                os.replace(tmpfile, darkfile)
+                DarkIndex.get(folder).add(darkfile)
+                # including the partials of an earlier call with more chunks
+                for partial in partialfolder.glob(f"{run}_{name}_chunk*.npz"):
+                    partial.unlink()
+                written.append(darkfile)
+    return written
@@ -1,16 +1,35 @@
 # felix zimmermann, github.com/fzimmermann89 for beamtime kuschel2023
 
-import dbpy
-import stpy
+import importlib
 import numpy as np
+import os
 import re
 from typing import List, Dict, Union #,Literal missing in 3.7
 from collections import namedtuple
 import datetime
-from functools import lru_cache
 import accumulators
+import darks
+import codec
 from pathlib import Path
 
+
+class _LazyModule:
+    """
+    imports the module on first use, i.e. reading results or submitting jobs does not need the SACLA libraries
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+dbpy = _LazyModule("dbpy")
+stpy = _LazyModule("stpy")
+
 ### Basic Helper functions
 def parseDate(date):
     if isinstance(date, datetime.datetime):
@@ -232,25 +251,22 @@ class LazyImage(np.lib.mixins.NDArrayOperatorsMixin):
     an image that will only be loaded on first access
     use .get() to get the data.
     """
-    def __init__(self, tag, obj, buff, dark, ev_per_adu):
+    def __init__(self, tag, read):
+        """
+        tag: tag of the image
+        read: function reading the (corrected) image of a tag, i.e. Detector._read
+        """
         self._tag = tag
-        self._obj = obj
-        self._buff = buff
+        self._read = read
         self._data = None
-        self._dark = dark
-        self._ev_per_adu = ev_per_adu
 
     def get(self):
         """
         get the image
         """
         if self._data is None:
-            self._obj.collect(self._buff, self._tag)
-            data = self._buff.read_det_data(0)
-            if self._dark is not None:
-                data = data - self._dark
-                self._dark = None
-            self._data = self._ev_per_adu * data
+            self._data = self._read(self._tag)
+            self._read = None
         return self._data
 
     def __array__(self):
@@ -264,7 +280,7 @@ class LazyImage(np.lib.mixins.NDArrayOperatorsMixin):
 ##### More fancy classes ######
 
 class Detector:
-    def __init__(self, detID: str, bl: int = 3, run: int = -1, dark: np.ndarray = None, ev_per_adu: Union[float,str] = 1.0, lazy=False):
+    def __init__(self, detID: str, bl: int = 3, run: int = -1, dark: np.ndarray = None, ev_per_adu: Union[float,str] = 1.0, lazy=False, projection=None, correction=None, batchsize=16):
         """
         A sacla detector at a specific run.
 
@@ -276,6 +292,11 @@ class Detector:
         dark: an numpy array (in ADU) to subtract or None
         ev_per_adu: "auto" or value. images is scaled by this factor before returning auto gets the value automatically from the gain.
         lazy: load image only on access. might not be threadsafe
+        projection: None or a calculators.Projection. if set, only the projection of each image is returned.
+            the dark is projected once and subtracted from the projected image.
+        correction: None or a corrections.DetectorCorrection (common mode, gain map, bad pixels). applied in place
+            to the dark subtracted images, before the projection.
+        batchsize: number of images corrected at once by read
         """
         if run < 0:
             run = getNewestRun(bl) + 1 + run
@@ -290,8 +311,15 @@ class Detector:
                 raise ValueError("if ev_per_adu is a string, only 'auto' is allowed")
             
         self._ev_per_adu = ev_per_adu
+        if projection is not None and dark is not None and correction is None:
+            # the corrections need the full image, otherwise the dark can be projected once
+            dark = projection(dark)
         self._dark = dark
+        self._projection = projection
+        self._correction = correction
+        self._batchsize = batchsize
         self._detID = detID
+        self._bl = bl
         self._run = run
         self.lazy = lazy
 
@@ -300,22 +328,196 @@ class Detector:
 
     def __repr__(self):
         return f"Detector {self._detID} at run {self._run}"
+
+    @property
+    def ev_per_adu(self):
+        """
+        the factor the images are scaled by, i.e. for droplets.DropletCounter
+        """
+        return self._ev_per_adu
+
+    def copy(self):
+        """
+        a copy with its own stpy reader and buffer, i.e. for use in another thread.
+        dark, gain and taglist are shared, nothing is read from the database.
+        """
+        ret = self.__class__.__new__(self.__class__)
+        ret.__dict__.update(self.__dict__)
+        ret._obj = stpy.StorageReader(self._detID, self._bl, (self._run,))
+        ret._buff = stpy.StorageBuffer(ret._obj)
+        return ret
     
-    @lru_cache(maxsize=1)
+    def _read_raw(self, tag, out=None):
+        """
+        read the (projected) image in ADU without corrections
+        """
+        self._obj.collect(self._buff, tag)
+        data = self._buff.read_det_data(0)
+        if self._projection is not None:
+            return self._projection(data, out=out)
+        if out is not None:
+            out[...] = data
+            return out
+        return data
+
+    def _read_corrected(self, tags, out=None):
+        """
+        read the images of tags as one block, subtract the dark and apply the correction in place.
+        the projection (if any) is applied last, the result is in ADU.
+        """
+        block = None
+        for j, tag in enumerate(tags):
+            self._obj.collect(self._buff, tag)
+            data = self._buff.read_det_data(0)
+            if block is None:
+                block = np.empty((len(tags),) + np.shape(data), dtype=np.result_type(data, np.float32))
+            block[j] = data
+        if self._dark is not None:
+            block -= self._dark
+        self._correction(block)
+        if self._projection is not None:
+            return self._projection(block, out=out)
+        if out is not None:
+            out[...] = block
+            return out
+        return block
+
+    def _read(self, tag):
+        """
+        read one image, dark subtracted, corrected and in ev
+        """
+        if self._correction is not None:
+            data = self._read_corrected([tag])[0]
+        else:
+            data = self._read_raw(tag)
+            if self._dark is not None:
+                data = data - self._dark
+        return self._ev_per_adu * data
+
     def __getitem__(self, idx):
         if idx>=len(self._taglist):
             raise IndexError
         tag = self._taglist[idx]
         if self.lazy:
-            return LazyImage(tag, self._obj, self._buff, dark=self._dark, ev_per_adu=self._ev_per_adu)
-        self._obj.collect(self._buff, tag)
-        data = self._buff.read_det_data(0)
+            return LazyImage(tag, self._read)
+        return self._read(tag)
+
+    def read(self, indices, out=None):
+        """
+        read multiple (projected) images as one array of shape (len(indices), ...)
+        with a correction, batchsize images are corrected at once.
+
+        Parameters
+        ----------
+        indices: shot indices to read
+        out: optional preallocated array to write to, i.e. a slice of an (n_shots, 1024) array
+        """
+        indices = np.asarray(indices, dtype=int)
+        if np.any(indices >= len(self._taglist)):
+            raise IndexError
+        if len(indices) == 0:
+            return np.zeros((0,))
+        if self._correction is not None:
+            tags = [self._taglist[idx] for idx in indices]
+            for start in range(0, len(tags), self._batchsize):
+                part = slice(start, start + self._batchsize)
+                data = self._read_corrected(tags[part], out=None if out is None else out[part])
+                if out is None:
+                    out = np.empty((len(indices),) + data.shape[1:], dtype=np.result_type(data, float))
+                    out[part] = data
+            out *= self._ev_per_adu
+            return out
+        for j, idx in enumerate(indices):
+            data = self._read_raw(self._taglist[idx], out=None if out is None else out[j])
+            if out is None:
+                out = np.empty((len(indices),) + np.shape(data), dtype=np.result_type(data, float))
+                out[j] = data
         if self._dark is not None:
-            data = data - self._dark
-        data = self._ev_per_adu * data
-        return data
+            out -= self._dark
+        out *= self._ev_per_adu
+        return out
+
+
+class DBRow:
+    """
+    a view of a single row of the DBReader columns.
+    the values are only indexed on access, no copy of the columns is made.
+    behaves like the DBValues namedtuple (attribute access, _fields, _asdict, iteration)
+    """
+    __slots__ = ("_columns", "_idx")
+
+    def __init__(self, columns, idx):
+        self._columns = columns
+        self._idx = idx
+
+    @property
+    def _fields(self):
+        return self._columns._fields
+
+    def __getattr__(self, name):
+        try:
+            column = getattr(self._columns, name)
+        except AttributeError:
+            raise AttributeError(name) from None
+        return column[self._idx]
+
+    def __getitem__(self, i):
+        return self._columns[i][self._idx]
+
+    def __len__(self):
+        return len(self._columns)
+
+    def __iter__(self):
+        return (column[self._idx] for column in self._columns)
+
+    def _asdict(self):
+        return {name: column[self._idx] for name, column in zip(self._columns._fields, self._columns)}
+
+    def __repr__(self):
+        return "DBRow(" + ", ".join(f"{name}={value!r}" for name, value in self._asdict().items()) + ")"
+
+
+class DBColumns:
+    """
+    the database columns of a run, behaving like a namedtuple of arrays.
+    each column is read from the database on first access.
+    """
+
+    def __init__(self, fields, load, data=None):
+        self._fields = tuple(fields)
+        self._load = load
+        self._data = {} if data is None else data
+
+    def __getattr__(self, name):
+        if name.startswith("_") or name not in self._fields:
+            raise AttributeError(name)
+        if name not in self._data:
+            self._data[name] = self._load(name)
+        return self._data[name]
+
+    def __getitem__(self, i):
+        return getattr(self, self._fields[i])
+
+    def __iter__(self):
+        return (getattr(self, name) for name in self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def _asdict(self):
+        return {name: getattr(self, name) for name in self._fields}
+
+    @property
+    def loaded(self):
+        """
+        names of the columns read so far
+        """
+        return [name for name in self._fields if name in self._data]
+
+    def __repr__(self):
+        return f"DBColumns({', '.join(self._fields)}), loaded: {', '.join(self.loaded)}"
+
 
-    
 class DBReader:
     def __init__(self, keys: Dict, bl: int = 3, run: int = -1):
         """
@@ -333,14 +535,15 @@ class DBReader:
         run: run number. if -1, use newest
 
 
-        Returns a named tuple of the database entrys named by the kezs in keys.
+        The values are stored columnwise as numpy arrays, each column is read on first access.
+        Indexing returns a DBRow, a view into the columns behaving like a named tuple of the database entrys named by the keys in keys.
         """
         if run < 0:
             run = getNewestRun(bl) + 1 + run
         self._taglist = dbpy.read_taglist_byrun(bl, run)
         self._keys = keys
-        hightag = getHighTag(bl, run)
-        data = {}
+        self._hightag = getHighTag(bl, run)
+        self._calibrations = {}
         for name, info in keys.items():
             if isinstance(info, str):
                 key, calibrate = info, lambda x: x
@@ -348,15 +551,34 @@ class DBReader:
                 key, calibrate = info
             elif isinstance(info, (list, tuple)) and len(info) == 2 and isinstance(info[0], str) and isinstance(info[1], float):
                 key = info[0]
-                calibrate = lambda x: x * info[1]
+                calibrate = lambda x, factor=info[1]: x * factor
             else:
                 raise ValueError("info must be a string or a tuple of string and float or callable")
-            raw = dbpy.read_syncdatalist_float(key, hightag, self._taglist)
-            data[name] = calibrate(np.array(raw))
-        data["tag"] = self._taglist
-        self._data = data
+            self._calibrations[name] = (key, calibrate)
         self._run = run
-        self._returntype = namedtuple("DBValues", data.keys())
+        self._returntype = namedtuple("DBValues", list(self._calibrations) + ["tag"])
+        self._columns = DBColumns(self._returntype._fields, self._load)
+
+    def _read(self, name, tags):
+        if name == "tag":
+            return np.asarray(tags)
+        key, calibrate = self._calibrations[name]
+        raw = dbpy.read_syncdatalist_float(key, self._hightag, tags) if len(tags) else []
+        return np.asarray(calibrate(np.array(raw, dtype=float)))
+
+    def _load(self, name):
+        return self._read(name, self._taglist)
+
+    def extend(self, tags):
+        """
+        read the values of additional tags (i.e. newly acquired shots of a running run)
+        and append them to the columns. only the new tags of the columns already loaded are read from the database.
+        """
+        if len(tags) == 0:
+            return
+        loaded = {name: np.concatenate((getattr(self._columns, name), self._read(name, tags))) for name in self._columns.loaded}
+        self._taglist = list(self._taglist) + list(tags)
+        self._columns = DBColumns(self._returntype._fields, self._load, loaded)
 
     def __len__(self):
         return len(self._taglist)
@@ -367,18 +589,88 @@ class DBReader:
     def __getitem__(self, idx):
         if idx>=len(self._taglist):
             raise IndexError
-        tag = self._taglist[idx]
-        data = {key: value[idx] for key, value in self._data.items()}
-        return self._returntype(**data)
-    
+        return DBRow(self._columns, idx)
+
+    def frame(self, indices=None):
+        """
+        get whole columns for a subset of shots
+
+        Parameters
+        ----------
+        indices: index array, boolean mask or slice of shots. None for all shots
+
+        Returns
+        -------
+        DBValues namedtuple of arrays (DBColumns if indices is None)
+        """
+        if indices is None:
+            return self._columns
+        if not isinstance(indices, slice):
+            indices = np.asarray(indices)
+        return self._returntype(*(column[indices] for column in self._columns))
+
+    def records(self, indices=None):
+        """
+        the columns of a subset of shots as a numpy record array
+        """
+        return np.rec.fromarrays(list(self.frame(indices)), names=list(self._returntype._fields))
+
     @property
     def data(self):
-        return self._returntype(**self._data)
+        return self._columns
+
+
+class Shot:
+    """
+    a shot of a Run, behaving like a namedtuple of the detector images and database values.
+    the values are only read on first access and kept, so each image is read once per shot.
+    """
+    __slots__ = ("_run", "_idx", "_values")
+
+    def __init__(self, run, idx):
+        self._run = run
+        self._idx = idx
+        self._values = {}
+
+    @property
+    def _fields(self):
+        return self._run._fields
+
+    def __getattr__(self, name):
+        values = self._values
+        if name in values:
+            return values[name]
+        run = self._run
+        if name in run.detectors:
+            value = run.detectors[name][self._idx]
+        else:
+            try:
+                column = getattr(run.db.data, name)
+            except AttributeError:
+                raise AttributeError(name) from None
+            value = column[self._idx]
+        values[name] = value
+        return value
+
+    def __getitem__(self, i):
+        return getattr(self, self._fields[i])
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __iter__(self):
+        return (getattr(self, name) for name in self._fields)
+
+    def _asdict(self):
+        return {name: getattr(self, name) for name in self._fields}
+
+    def __repr__(self):
+        return f"Shot {self._idx} of run {self._run._run} ({', '.join(self._fields)})"
 
 
 class Run:
     def __init__(
-        self, detector_keys: Dict, database_keys: Dict, detector_dark_paths: Dict = None, bl: int = 3, run: int = -1, lazy:bool=True, detectors_in_ev = True
+        self, detector_keys: Dict, database_keys: Dict, detector_dark_paths: Dict = None, bl: int = 3, run: int = -1, lazy:bool=True, detectors_in_ev = True, detector_projections: Dict = None, fields=None, detector_corrections: Dict = None
     ):
         """
         A Sacla run
@@ -392,6 +684,10 @@ class Run:
         run: run to use. if negative, relative from newest
         lazy: load det images lazyly on first access
         detectors_in_ev: detectors are returned in ev(ish)
+        detector_projections: dict of name:calculators.Projection for detectors of which only a projection is needed, see Detector
+        detector_corrections: dict of name:corrections.DetectorCorrection for detectors to correct (common mode, gain, bad pixels)
+        fields: names of the detectors and database keys to use. the others are never opened, read or looked up
+            (darks). None for all. the database columns are read on first access.
         
 
         Usage
@@ -401,31 +697,118 @@ class Run:
             for shot in Run(...):
                 ...
 
-        each shot is a namedtuple.
+        each shot is a Shot, behaving like a namedtuple. detector images and database values are only read on access.
         """
+        if run < 0:
+            run = getNewestRun(bl) + 1 + run
+        if fields is not None:
+            fields = set(fields)
+            unknown = fields - set(detector_keys) - set(database_keys) - {"tag"}
+            if unknown:
+                raise ValueError(f"unknown fields {', '.join(sorted(unknown))}")
+            detector_keys = {name: key for name, key in detector_keys.items() if name in fields}
+            database_keys = {name: key for name, key in database_keys.items() if name in fields}
         self.detectors = {}
+        center = None
         for name, detID in detector_keys.items():
             if detector_dark_paths is not None and name in detector_dark_paths and detector_dark_paths[name] is not None:
-                darkfilename = find_closest_darkfile(detector_dark_paths[name], bl=bl,run=run)
+                if center is None:
+                    center = getRunCenterTime(bl, run)
+                darkfilename = find_closest_darkfile(detector_dark_paths[name], bl=bl, run=run, center=center)
                 if darkfilename is None:
                     print("No dark found in folder!")
                     dark = None
                 else:
-                    dark = np.load(darkfilename)
+                    dark = darks.load_dark(str(darkfilename))
             else:
                 dark = None
-            det = Detector(detID, bl=bl, run=run, dark=dark, lazy=lazy, ev_per_adu="auto" if detectors_in_ev else 1.0)
+            projection = None if detector_projections is None else detector_projections.get(name)
+            correction = None if detector_corrections is None else detector_corrections.get(name)
+            det = Detector(detID, bl=bl, run=run, dark=dark, lazy=lazy, ev_per_adu="auto" if detectors_in_ev else 1.0, projection=projection, correction=correction)
             self.detectors[name] = det
         self.db = DBReader(database_keys, bl, run)
-        self._returntype = namedtuple("Shot", field_names=list(self.detectors.keys()) + list(self.db._returntype._fields))
-        self.__dict__.update(**self.db.data._asdict())
+        self._bl = bl
+        self._run = run
+        self._fields = tuple(self.detectors) + self.db._returntype._fields
+        # new shots not added by update because of max_new
+        self.skipped = 0
+
+    def __getattr__(self, name):
+        # database columns as attributes, read on first access
+        if name.startswith("_") or "db" not in self.__dict__:
+            raise AttributeError(name)
+        try:
+            return getattr(self.db.data, name)
+        except AttributeError:
+            raise AttributeError(name) from None
+
     def __getitem__(self, idx):
         if idx>=len(self):
             raise IndexError
-        detdata = {name: det[idx] for name, det in self.detectors.items()}
-        dbdata = self.db[idx]._asdict()
-        return self._returntype(**detdata, **dbdata)
+        return Shot(self, idx)
+
+    def db_frame(self, indices=None):
+        """
+        database values for a subset of shots as whole columns
+        
+        Parameters
+        ----------
+        indices: index array, boolean mask or slice of shots. None for all shots
+
+        Returns
+        -------
+        DBValues namedtuple of arrays
+        """
+        return self.db.frame(indices)
     
+    def copy(self):
+        """
+        a copy with its own detector readers, i.e. for use in another thread.
+        the database values are shared.
+        """
+        ret = self.__class__.__new__(self.__class__)
+        ret.__dict__.update(self.__dict__)
+        ret.detectors = {name: det.copy() for name, det in self.detectors.items()}
+        return ret
+
+    def update(self, max_new=None):
+        """
+        look for shots acquired since the Run was created or last updated
+        and read the database values only for the new shots.
+        The database has no query for the tags after a given tag, so the tag list of the run is read,
+        but only the tags after the last known one are added. If the known tags are not in the list
+        anymore, the run is reloaded and all its shots are new.
+
+        Parameters
+        ----------
+        max_new: None or the maximum number of new shots added. the older new shots are skipped
+            (counted in skipped), they are not part of the Run, so its indices differ from the tag list of the run.
+
+        Returns
+        -------
+        range of the indices of the new shots
+        """
+        n = len(self)
+        known = self.db._taglist
+        tags = np.asarray(dbpy.read_taglist_byrun(self._bl, self._run))
+        if n and not np.isin(known, tags).all():
+            print(f"the tags of run {self._run} changed, reloading")
+            self.db = DBReader(self.db._keys, self._bl, self._run)
+            for det in self.detectors.values():
+                det._taglist = self.db._taglist
+            return range(0, len(self))
+        newtags = tags[tags > known[-1]] if n else tags
+        if max_new is not None and len(newtags) > max_new:
+            self.skipped += len(newtags) - max_new
+            newtags = newtags[len(newtags) - max_new:]
+        if len(newtags) == 0:
+            return range(n, n)
+        self.db.extend(newtags.tolist())
+        # the detectors read by index into the same tag list
+        for det in self.detectors.values():
+            det._taglist = self.db._taglist
+        return range(n, len(self))
+
     def __len__(self):
         if self.db is not None:
             return len(self.db)
@@ -435,56 +818,121 @@ class Run:
             return 0
     
 
-def find_closest_darkfile(path,bl:int=3,run:int=-1):
+def getRunCenterTime(bl=3, run=-1):
+    """
+    middle of the run as timestamp
+    """
+    start, end = (el.timestamp() for el in getRunTime(bl, run))
+    return (start + end) / 2
+
+
+def find_closest_darkfile(path,bl:int=3,run:int=-1, center:float=None):
     """
     darkfiles have to be named *_{timestamp}.np?"
     returns filename of file that has timestime
     closest to the middle of the run
+    The lookup uses the (persisted) DarkIndex of the folder.
     
     Parameters:
     --------
         path: path to look
         run: run number, negative to be relative to last run
         bl: beamline
+        center: timestamp of the middle of the run. if None, it is read from the database
     """
-    start,end = (el.timestamp() for el in getRunTime(bl,run))
-    center = (start+end)/2 #middle of the run
-    files_and_times=[]
-    for file in (Path(path).rglob("*_*.np?")):
-        try:
-            time = float(file.stem.split("_")[-1])
-            files_and_times.append((time,file))
-        except (ValueError, IndexError):
-            continue
-    if len(files_and_times)==0:
-        #nothing found
-        darkfile= None
-    else:
-        #find closest darkfile to middle of the run
-        darkfile=sorted(files_and_times,key=lambda el:abs(el[0]-center))[0][1]
-    return darkfile
+    if center is None:
+        center = getRunCenterTime(bl, run) 
+    return darks.DarkIndex.get(path).closest(center)
+
+
+
+def accumulator_to_dict(name, acc):
+    """
+    the value of an accumulator as name and, if the accumulator supports it, the full state
+    as name/key entries. state entries that are the value itself are not stored twice
+    but listed in name/_aliases.
+    """
+    value = acc.value
+    ret = {name: value}
+    try:
+        state = acc.state_dict()
+    except NotImplementedError:
+        return ret
+    aliases = []
+    for key, item in state.items():
+        if item is value:
+            aliases.append(key)
+        else:
+            ret[f"{name}/{key}"] = item
+    ret[f"{name}/_aliases"] = np.array([alias.encode() for alias in aliases], dtype=bytes)
+    return ret
+
+
+def accumulator_from_results(data, name):
+    """
+    recreate an accumulator stored by to_dict from the results (i.e. a loaded npz file)
+    """
+    files = data.files if hasattr(data, "files") else data.keys()
+    if f"{name}/_class" not in files:
+        raise KeyError(f"no accumulator state for {name} in results. was it created before states were saved?")
+    prefix = f"{name}/"
+    state = {key[len(prefix):]: data[key] for key in files if key.startswith(prefix) and key != f"{name}/_aliases"}
+    for key in data[f"{name}/_aliases"]:
+        state[key.decode() if isinstance(key, bytes) else str(key)] = data[name]
+    return accumulators.Accumulator.from_state(state)
+
+
+def bin_run(run, key, bin_edges, detectors, shots=None, transform=None, batchsize=16):
+    """
+    mean detector images per bin of a database column (i.e. a motor position) of a run.
+    the bins of all shots are calculated from the column at once, the images are read in batches
+    (Detector.read) and summed with one reduction per bin and batch. shots outside of the bins are not read.
 
+    Parameters
+    ----------
+    run: Run
+    key: database column to bin by, i.e. "sampleY"
+    bin_edges: edges of the bins, the same for all runs of a scan
+    detectors: names of the detectors to bin
+    shots: shot indices to use, i.e. the good shots of the filters. None for all
+    transform: None or callable applied to each batch of images (n, ...), i.e. a NoiseCutter
+    batchsize: number of images read and reduced at once
+
+    Returns
+    -------
+    dict of detector: accumulators.ScanBinner. saved with to_dict, the ScanBinners of the runs
+    of a scan can be merged shot accurately with aggregate.aggregate_runs
+    """
+    shots = np.arange(len(run)) if shots is None else np.asarray(shots)
+    coords = np.asarray(getattr(run, key), dtype=float)[shots]
+    binners = {name: accumulators.ScanBinner(bin_edges) for name in detectors}
+    if len(binners) == 0:
+        return binners
+    inside = next(iter(binners.values())).bin_indices(coords) >= 0
+    shots, coords = shots[inside], coords[inside]
+    for start in range(0, len(shots), batchsize):
+        part = slice(start, start + batchsize)
+        for name, binner in binners.items():
+            images = run.detectors[name].read(shots[part])
+            binner.add(coords[part], images if transform is None else transform(images))
+    return binners
 
 
 def to_dict(run,shots_taken=None, **kwargs):
     """
     convert run and **kwargs to a dict of arrays.
-    for accumulators, the value is used
+    for accumulators, the value is used and the state is added as name/key (see accumulator_from_results)
+    for PerShotRecorders, each column is used by its name
     shots_taken are the good shots, the database values from run are subset on these
     """
     ret = {}
-    if shots_taken is None:
-        ret.update(**run.db.data._asdict())
-    else:
-        for name, value in run.db.data._asdict().items():
-            try:
-                ret[name]=np.array(value)[shots_taken]
-            except Exception as e:
-                print("could not convert", name, e)
+    ret.update(**run.db_frame(shots_taken)._asdict())
     for name, value in kwargs.items():
         try:
-            if isinstance(value,accumulators.Accumulator):
-                ret[name] = value.value
+            if isinstance(value,accumulators.PerShotRecorder):
+                ret.update(value.value)
+            elif isinstance(value,accumulators.Accumulator):
+                ret.update(accumulator_to_dict(name, value))
             else:
                 ret[name] = value
         except Exception as e:
@@ -494,7 +942,7 @@ def to_dict(run,shots_taken=None, **kwargs):
 
 def read_data_generator(path, minrun=0, maxrun=9313254, get_run_from_filename=True):
     """
-    reads cached results, named data*
+    reads cached results, named data*, as codec.Results (encoded images are decoded on access)
     if get_run_from_filename, the filename is used as a fast run number filter
     the filename shoud be *run{runnr}.npz for that to work
     """
@@ -506,7 +954,61 @@ def read_data_generator(path, minrun=0, maxrun=9313254, get_run_from_filename=Tr
             runnr = int(file.stem.split("run")[-1])
             if not (minrun<=runnr and  runnr<=maxrun):
                 continue
-        f=np.load(file)
+        f=codec.load(file)
         runnr=int(f["runNR"])
         if minrun<=runnr and  runnr<=maxrun:
-            yield f
\ No newline at end of file
+            yield f
+
+def checkpoint_file(result_file):
+    """
+    the checkpoint of a result file, hidden next to it
+    """
+    result_file = Path(result_file)
+    return result_file.with_name(f".{result_file.name}.checkpoint")
+
+
+def save_checkpoint(path, processed_tags, **objects):
+    """
+    atomically save the state of accumulators (or anything with a state_dict method)
+    together with the tags already processed to a compressed npz file.
+    arrays in objects are saved as they are.
+    """
+    path = Path(path)
+    data = {"processed_tags": np.asarray(processed_tags)}
+    for name, obj in objects.items():
+        if hasattr(obj, "state_dict"):
+            for key, value in obj.state_dict().items():
+                data[f"{name}/{key}"] = value
+        else:
+            data[name] = np.asarray(obj)
+    tmpfile = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmpfile, "wb") as f:
+        np.savez_compressed(f, **data)
+    os.replace(tmpfile, path)
+
+
+def load_checkpoint(path):
+    """
+    load a checkpoint written by save_checkpoint
+
+    Returns
+    -------
+    processed_tags: array of tags
+    states: dict of name: state dict (for accumulators) or array
+    If the checkpoint does not exist, no tags and an empty dict are returned.
+    """
+    path = Path(path)
+    if not path.exists():
+        return np.zeros(0, dtype=int), {}
+    states = {}
+    with np.load(path) as f:
+        processed_tags = f["processed_tags"]
+        for key in f.files:
+            if key == "processed_tags":
+                continue
+            if "/" in key:
+                name, statekey = key.split("/", 1)
+                states.setdefault(name, {})[statekey] = f[key]
+            else:
+                states[key] = f[key]
+    return processed_tags, states
@@ -0,0 +1,98 @@
+# felix zimmermann, github.com/fzimmermann89 for beamtime kuschel2023
+
+"""
+Droplet photon counting: connected pixels above a threshold (droplets) are combined,
+as the charge of a photon can be shared between pixels, and the photon number of each
+droplet is assigned from its summed energy.
+"""
+
+from collections import namedtuple
+import numpy as np
+from sparse import label_hits
+
+
+class DropletResult(namedtuple("DropletResult", ["energy", "photons", "frame", "row", "col", "shape"])):
+    """
+    the droplets of a frame or stack of frames, one entry per droplet:
+    energy (in eV), photons (assigned photon number), frame (index in the stack, 0 for a single frame),
+    row and col (energy weighted center, rounded to pixels). shape is the shape of the input.
+    """
+
+    __slots__ = ()
+
+    @property
+    def total(self):
+        """
+        total number of photons
+        """
+        return int(np.sum(self.photons))
+
+    def photon_map(self):
+        """
+        photon counts per pixel (of the input shape), the photons of a droplet at its center
+        """
+        ret = np.zeros(self.shape, dtype=np.int32)
+        index = np.ravel_multi_index((self.frame, self.row, self.col), (int(np.prod(self.shape[:-2])),) + tuple(self.shape[-2:]))
+        np.add.at(ret.reshape(-1), index, self.photons)
+        return ret
+
+    def photons_per_frame(self):
+        """
+        number of photons in each frame of a stack
+        """
+        return np.bincount(self.frame, self.photons, minlength=int(np.prod(self.shape[:-2]))).astype(np.int64)
+
+
+class DropletCounter:
+    def __init__(self, photon_energy, threshold=None, ev_per_adu=1.0, connectivity=8):
+        """
+        Droplet photon counting for MPCCD frames.
+
+        Parameters
+        ----------
+        photon_energy: energy of the photons in eV, i.e. the fluorescence line
+        threshold: pixels above threshold (in eV) belong to droplets, should be well above the noise
+            but low enough to keep the pixels with a small share of the charge. default: a quarter of the photon energy
+        ev_per_adu: calibration of the images, 1 for images in eV (Detector with ev_per_adu="auto"),
+            Detector.ev_per_adu for images in ADU
+        connectivity: 4 or 8, pixels sharing an edge (or a corner) belong to the same droplet
+
+        Usage
+        ------
+        counter = DropletCounter(6400)
+        droplets = counter(image)  # or a stack of images
+        droplets.photon_map(), droplets.energy
+        """
+        self.photon_energy = photon_energy
+        self.threshold = photon_energy / 4 if threshold is None else threshold
+        self.ev_per_adu = ev_per_adu
+        self.connectivity = connectivity
+
+    def __repr__(self):
+        return f"DropletCounter at {self.photon_energy} eV, threshold {self.threshold} eV"
+
+    def __call__(self, images):
+        """
+        the droplets of an image or a stack of images (last two axes are the image axes)
+        """
+        images = np.asarray(images)
+        if images.ndim < 2:
+            raise ValueError("images must be at least 2d")
+        # threshold in ADU, so only the hits are converted
+        index = np.flatnonzero(images > self.threshold / self.ev_per_adu)
+        value = images.reshape(-1)[index] * self.ev_per_adu
+        labels = label_hits(index, images.shape, self.connectivity)
+        n = int(labels.max()) + 1 if len(labels) else 0
+        energy = np.bincount(labels, value, minlength=n)
+        frame, row, col = np.unravel_index(index, (int(np.prod(images.shape[:-2])),) + images.shape[-2:])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            center_row = np.rint(np.bincount(labels, value * row, minlength=n) / energy).astype(np.intp)
+            center_col = np.rint(np.bincount(labels, value * col, minlength=n) / energy).astype(np.intp)
+        # all pixels of a droplet are in the same frame
+        droplet_frame = np.zeros(n, dtype=np.intp)
+        droplet_frame[labels] = frame
+        photons = np.rint(energy / self.photon_energy).astype(np.int32)
+        return DropletResult(energy, photons, droplet_frame, center_row, center_col, images.shape)
+
+    def photon_map(self, images):
+        return self(images).photon_map()
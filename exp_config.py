@@ -3,6 +3,8 @@
 
 from attenuator import attenuator_eh5_silicon_thickness
 import numpy as np
+from codec import Codec
+from calculators import ROI
 
 # add point data here. format is one of
 # name: databasekey
@@ -50,3 +52,47 @@ spectrometer_axis_iron = np.arange(-512,512)*spectrometer_ev_per_pixel_fe+spectr
 spectrometer_ev_per_pixel_au = 0.817
 spectrometer_center_ev_au = 9674.6
 spectrometer_axis_gold= np.arange(-512,512)*spectrometer_ev_per_pixel_au+spectrometer_center_ev_au
+
+# fluorescence region of the side detector, its mean is recorded per shot as side_roi_mean
+side_roi = ROI(rows=(270, 920), cols=(580, 1070))
+
+
+#### Analysis pipeline, see pipeline.py #####
+# the same quantities as analyserun in analyse.py, with the same names
+analysis_pipeline = {
+    "spectrum": {"stage": "projection", "input": "spectrometer", "axis": 1, "pershot": True},
+    "spectrum_mean": {"stage": "mean", "input": "spectrum"},
+    "side_cut": {"stage": "noise_cut", "input": "side_ccd", "threshold": 1000},
+    "side_total": {"stage": "sum", "input": "side_cut"},
+    "side_mean": {"stage": "mean", "input": "side_cut"},
+    "side_roi_mean": {"stage": "region", "input": "side_cut", "roi": side_roi, "reduce": "mean"},
+    "side_max": {"stage": "max", "input": "side_ccd"},
+    "side_bright_pershot": {"stage": "count", "input": "side_ccd", "low": 40},
+    "side_hist": {"stage": "histogram", "input": "side_ccd", "bins": 200, "range": (0, 50000)},
+    "side_hist_mean": {"stage": "mean", "input": "side_hist"},
+    "forward_cut": {"stage": "noise_cut", "input": "forward_ccd", "threshold": 1000},
+    "forward_total": {"stage": "sum", "input": "forward_cut"},
+    "forward_mean": {"stage": "mean", "input": "forward_cut"},
+    "forward_hist": {"stage": "histogram", "input": "forward_ccd", "bins": 200, "range": (0, 50000)},
+    "forward_hist_mean": {"stage": "mean", "input": "forward_hist"},
+    # 5 brightest images
+    "top": {"stage": "topk", "input": "forward_cut", "k": 5, "by": "forward_total", "keep": ["forward_cut", "side_cut", "side_total"],
+            "names": ["forward_top_images", "side_top_image", "side_top_image_sum", "forward_top_image_sum", "i_top_images"]},
+}
+
+
+#### Storage of the large images in the results, see codec.py #####
+# fnmatch pattern of the result key: Codec. the images are in eV (Run converts them with the detector's ev_per_adu),
+# so the top images are stored as integers quantized to 1 eV, far below the 1000 eV noise cut.
+# the keys are given explicitly, so the per shot columns and the accumulator states (i.e. side_mean/value,
+# used by aggregate_runs) are stored lossless
+result_codecs = {
+    "forward_top_images": Codec("int", scale=1.0),
+    "side_top_image": Codec("int", scale=1.0),
+    "side_mean": Codec("float32"),
+    "forward_mean": Codec("float32"),
+    "spectrum_mean": Codec("float32"),
+    "side_hist_mean": Codec("float32"),
+    "forward_hist_mean": Codec("float32"),
+    "side_max": Codec("float32"),
+}
@@ -0,0 +1,207 @@
+# felix zimmermann, github.com/fzimmermann89 for beamtime kuschel2023
+
+import os
+import time
+import numpy as np
+from pathlib import Path
+import accumulators
+from data_helper import Run, getNewestRun, getTags
+
+
+def default_process(shot, detector_names):
+    """
+    per shot quantities of the default monitor: the images and their sums
+    """
+    ret = {}
+    for name in detector_names:
+        image = np.asarray(getattr(shot, name))
+        ret[name] = image
+        ret[f"{name}_sum"] = np.sum(image)
+    return ret
+
+
+class OnlineMonitor:
+    def __init__(
+        self,
+        detector_keys,
+        database_keys,
+        detector_dark_paths=None,
+        output="monitor.npz",
+        bl=3,
+        process=None,
+        lifetime=100,
+        history=1000,
+        max_shots_per_update=20,
+        max_update_time=5.0,
+        poll_interval=2.0,
+    ):
+        """
+        Follows the currently acquiring run and keeps rolling results of the newest shots.
+
+        New shots are found with Run.update, i.e. only the database values of new tags are read.
+        Each new shot is reduced by process(shot) to a dict of name:value. For each name
+        RunningMean and RunningVariance (with the given lifetime in shots) are accumulated,
+        for scalar values the last `history` values are kept in a CacheAccumulator.
+        After each update the results are written atomically to output (npz), see read_monitor.
+
+        To bound the latency, at most max_shots_per_update of the newest shots are added to the Run
+        (so the database is only read for them) and at most max_update_time seconds are spent per update.
+        Older shots are skipped.
+        The accumulators are reset when a new run starts.
+
+        Parameters
+        ----------
+        detector_keys, database_keys, detector_dark_paths: see Run
+        output: npz file to write the results to
+        bl: beamline
+        process: callable(shot)->dict of per shot values. default: images and image sums of all detectors
+        lifetime: lifetime of the running mean and variance in shots
+        history: number of values kept for scalar quantities
+        max_shots_per_update: maximum number of shots processed per update
+        max_update_time: maximum time per update in s
+        poll_interval: time between updates in s if no new shots are found
+        """
+        self.detector_keys = detector_keys
+        self.database_keys = database_keys
+        self.detector_dark_paths = detector_dark_paths
+        self.output = Path(output)
+        self.bl = bl
+        self.process = process if process is not None else lambda shot: default_process(shot, detector_keys)
+        self.lifetime = lifetime
+        self.history = history
+        self.max_shots_per_update = max_shots_per_update
+        self.max_update_time = max_update_time
+        self.poll_interval = poll_interval
+        self.run = None
+        self.runNR = None
+        self._reset()
+
+    def __repr__(self):
+        return f"OnlineMonitor at run {self.runNR}, {self.n_processed} shots processed"
+
+    def _reset(self):
+        self.means = {}
+        self.variances = {}
+        self.histories = {}
+        self.tags = accumulators.CacheAccumulator(self.history)
+        self.n_processed = 0
+        self.n_skipped = 0
+
+    def _follow_newest_run(self):
+        newest = getNewestRun(self.bl)
+        if newest != self.runNR:
+            if len(getTags(self.bl, run=newest)) == 0:
+                # run has just started
+                return range(0)
+            self.run = Run(self.detector_keys, self.database_keys, self.detector_dark_paths, bl=self.bl, run=newest, lazy=False)
+            self.runNR = newest
+            self._reset()
+            return range(len(self.run))
+        skipped = self.run.skipped
+        new = self.run.update(max_new=self.max_shots_per_update)
+        self.n_skipped += self.run.skipped - skipped
+        return new
+
+    def _accumulate(self, name, value):
+        if name not in self.means:
+            self.means[name] = accumulators.RunningMean(lifetime=self.lifetime)
+            self.variances[name] = accumulators.RunningVariance(lifetime=self.lifetime)
+            if np.ndim(value) == 0:
+                self.histories[name] = accumulators.CacheAccumulator(self.history)
+        self.means[name].accumulate(value)
+        self.variances[name].accumulate(value)
+        if name in self.histories:
+            self.histories[name].accumulate(value)
+
+    def update(self):
+        """
+        process the newest shots and publish the results
+
+        Returns
+        -------
+        number of processed shots
+        """
+        start = time.monotonic()
+        new = self._follow_newest_run()
+        if len(new) > self.max_shots_per_update:
+            self.n_skipped += len(new) - self.max_shots_per_update
+            new = new[-self.max_shots_per_update:]
+        processed = 0
+        for idx in new:
+            if time.monotonic() - start > self.max_update_time:
+                self.n_skipped += len(new) - processed
+                break
+            shot = self.run[idx]
+            for name, value in self.process(shot).items():
+                self._accumulate(name, value)
+            self.tags.accumulate(shot.tag)
+            processed += 1
+        self.n_processed += processed
+        if processed:
+            self.publish()
+        return processed
+
+    @property
+    def value(self):
+        """
+        the current results as dict of arrays
+        """
+        ret = {"runNR": self.runNR, "n_processed": self.n_processed, "n_skipped": self.n_skipped, "time": time.time(), "tag": np.array(self.tags.value)}
+        for name in self.means:
+            ret[f"{name}_mean"] = self.means[name].value
+            ret[f"{name}_std"] = np.sqrt(self.variances[name].rms)
+        for name, history in self.histories.items():
+            ret[f"{name}_history"] = np.array(history.value)
+        return ret
+
+    def publish(self):
+        """
+        atomically write the current results to the output file
+        """
+        tmpfile = self.output.with_name(f".{self.output.name}.{os.getpid()}.tmp")
+        with open(tmpfile, "wb") as f:
+            np.savez(f, **self.value)
+        os.replace(tmpfile, self.output)
+
+    def serve(self, duration=np.inf):
+        """
+        update in a loop for duration seconds (default forever)
+        """
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            try:
+                processed = self.update()
+            except KeyboardInterrupt:
+                break
+            if not processed:
+                time.sleep(self.poll_interval)
+
+
+def read_monitor(path="monitor.npz"):
+    """
+    read the results published by an OnlineMonitor as a dict, i.e. to plot them in a notebook
+    """
+    with np.load(path) as f:
+        return {key: f[key] for key in f.files}
+
+
+if __name__ == "__main__":
+    import argparse
+    import exp_config
+
+    parser = argparse.ArgumentParser(description="follow the newest run and publish rolling results")
+    parser.add_argument("output", nargs="?", default="monitor.npz")
+    parser.add_argument("--lifetime", type=float, default=100)
+    parser.add_argument("--max-shots", type=int, default=20, help="maximum number of new shots per update, older new shots are skipped")
+    args = parser.parse_args()
+
+    monitor = OnlineMonitor(
+        exp_config.detector_keys,
+        exp_config.database_keys,
+        exp_config.detector_dark_paths,
+        output=args.output,
+        lifetime=args.lifetime,
+        max_shots_per_update=args.max_shots,
+    )
+    print("publishing to", monitor.output)
+    monitor.serve()
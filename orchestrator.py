@@ -0,0 +1,362 @@
+# felix zimmermann, github.com/fzimmermann89 for beamtime kuschel2023
+
+import os
+import sys
+import json
+import time
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from aggregate import run_files
+from data_helper import checkpoint_file
+
+ANALYSE = Path(__file__).resolve().parent / "analyse.py"
+
+PBS_TEMPLATE = """#PBS -S /bin/bash
+#PBS -q {queue}
+#PBS -l nodes=1
+#PBS -l walltime={walltime}
+
+source /home/blstaff/SACLAtool_py3.7
+module load SACLA_tool/1.0.0
+module load python/SACLA_python-3.7/offline
+
+python {orchestrator} element {plan} ${{PBS_ARRAY_INDEX:-1}}
+"""
+
+
+def _remove(path):
+    if path.exists():
+        path.unlink()
+
+
+def pending_runs(runs, results, newer_than=None):
+    """
+    runs without a result file in results or with a result older than newer_than
+
+    Parameters
+    ----------
+    runs: run numbers to check
+    results: folder of the result files (data*run{runnr}.npz)
+    newer_than: timestamp, or a file whose modification time is used, i.e. the analysis script.
+        results written before are stale. None: only missing results are pending.
+    """
+    if isinstance(newer_than, (str, Path)):
+        newer_than = os.path.getmtime(newer_than)
+    existing = {runnr: file for runnr, file in run_files(results)}
+    ret = []
+    for run in runs:
+        run = int(run)
+        if run not in existing or (newer_than is not None and existing[run].stat().st_mtime < newer_than):
+            ret.append(run)
+    return ret
+
+
+def pack_runs(runs, runs_per_job):
+    """
+    split runs into lists of at most runs_per_job consecutive runs
+    """
+    runs = sorted(runs)
+    return [runs[i:i + runs_per_job] for i in range(0, len(runs), runs_per_job)]
+
+
+def run_element(planfile, index):
+    """
+    run the analysis of all runs of array element index (starting at 1) of a plan in one process.
+    the state of each run is tracked by marker files in the status folder of the plan:
+    {run}.started while running, {run}.done on success, one line per failure in {run}.failed.
+    a run succeeded if its result file was written.
+
+    Returns
+    -------
+    number of failed runs
+    """
+    with open(planfile) as f:
+        plan = json.load(f)
+    status = Path(plan["status"])
+    runs = plan["elements"][index - 1]
+    for run in runs:
+        _remove(status / f"{run}.queued")
+        (status / f"{run}.started").touch()
+    start = time.time()
+    ret = subprocess.run([sys.executable, plan["script"]] + [str(run) for run in runs] + plan["args"]).returncode
+    written = {runnr for runnr, file in run_files(plan["results"], min(runs), max(runs)) if file.stat().st_mtime >= start}
+    failed = 0
+    for run in runs:
+        if run in written:
+            (status / f"{run}.done").touch()
+        else:
+            failed += 1
+            with open(status / f"{run}.failed", "a") as f:
+                f.write(f"{time.time()} {ret}\n")
+        _remove(status / f"{run}.started")
+    return failed
+
+
+class LocalBackend:
+    def __init__(self, workers=4):
+        """
+        runs the array elements of a plan as subprocesses on this machine, workers at a time.
+        the same as on the queue, only without PBS.
+        """
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.futures = []
+
+    def submit(self, planfile, indices):
+        cmd = [sys.executable, str(Path(__file__).resolve()), "element", str(planfile)]
+        for i in indices:
+            self.futures.append(self.pool.submit(subprocess.run, cmd + [str(i)]))
+
+    def wait(self):
+        for f in self.futures:
+            f.result()
+        self.futures = []
+
+
+class PBSBackend:
+    def __init__(self, queue="serial", walltime="1:00:00", logs="logs", max_array=500):
+        """
+        submits the array elements of a plan as PBS array jobs with qsub.
+
+        Parameters
+        ----------
+        queue: PBS queue
+        walltime: walltime of each array element
+        logs: folder for the stdout and stderr of the jobs
+        max_array: maximum number of elements per array job
+        """
+        self.queue = queue
+        self.walltime = walltime
+        self.logs = Path(logs)
+        self.max_array = max_array
+
+    def submit(self, planfile, indices):
+        planfile = Path(planfile)
+        script = planfile.with_suffix(".pbs")
+        script.write_text(PBS_TEMPLATE.format(queue=self.queue, walltime=self.walltime, orchestrator=Path(__file__).resolve(), plan=planfile.resolve()))
+        self.logs.mkdir(parents=True, exist_ok=True)
+        indices = sorted(indices)
+        for i in range(0, len(indices), self.max_array):
+            first, last = indices[i], indices[min(i + self.max_array, len(indices)) - 1]
+            # a single element is not an array job, PBS_ARRAY_INDEX is set by hand
+            array = ["-J", f"{first}-{last}"] if last > first else ["-v", f"PBS_ARRAY_INDEX={first}"]
+            subprocess.run(["qsub", "-o", str(self.logs), "-e", str(self.logs)] + array + [str(script)], check=True)
+
+    def wait(self):
+        pass
+
+
+class Orchestrator:
+    def __init__(self, results, workdir="jobs", backend=None, script=ANALYSE, args=(), runs_per_job=5, max_retries=2, timeout=3600, queue_timeout=86400):
+        """
+        Submits the analysis of all runs that have no (or an outdated) result and keeps track of them.
+
+        Several runs are packed into each array element to reduce the scheduling overhead of short runs.
+        The state of the runs is tracked by marker files written by the jobs into workdir/status,
+        runs that were started or queued too long ago are marked as failed by expire and
+        failed runs can be resubmitted with resubmit_failed.
+
+        Parameters
+        ----------
+        results: folder of the result files (data*run{runnr}.npz) written by script
+        workdir: folder for the plans and status files
+        backend: PBSBackend() (default) or LocalBackend()
+        script: analysis script, called as python script RUN [RUN ...] *args
+        args: additional arguments of script
+        runs_per_job: number of runs per array element
+        max_retries: failed runs are resubmitted at most this often
+        timeout: runs started more than timeout s ago without finishing are stale (killed by the queue)
+        queue_timeout: runs queued more than queue_timeout s ago without starting are stale (deleted from the queue)
+        """
+        self.results = Path(results)
+        self.workdir = Path(workdir)
+        self.status_path = self.workdir / "status"
+        self.status_path.mkdir(parents=True, exist_ok=True)
+        self.backend = backend if backend is not None else PBSBackend()
+        self.script = Path(script)
+        self.args = [str(a) for a in args]
+        self.runs_per_job = runs_per_job
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+
+    def __repr__(self):
+        counts = {}
+        for state in self.status().values():
+            counts[state] = counts.get(state, 0) + 1
+        return f"Orchestrator for {self.results}, {counts}"
+
+    def _marker(self, run, state):
+        return self.status_path / f"{run}.{state}"
+
+    def failures(self, run):
+        """
+        number of failed attempts of run
+        """
+        marker = self._marker(run, "failed")
+        return len(marker.read_text().splitlines()) if marker.exists() else 0
+
+    def _age(self, run, state):
+        """
+        seconds since the marker of state was written, None if there is none
+        """
+        try:
+            return time.time() - self._marker(run, state).stat().st_mtime
+        except FileNotFoundError:
+            return None
+
+    def state(self, run):
+        """
+        one of "done", "running", "queued", "failed", "new" or "stale"
+        (started or queued longer than the timeouts ago, see expire). reading the state changes nothing.
+        """
+        for marker, timeout, state in (("started", self.timeout, "running"), ("queued", self.queue_timeout, "queued")):
+            age = self._age(run, marker)
+            if age is not None:
+                return state if age < timeout else "stale"
+        if self._marker(run, "done").exists():
+            return "done"
+        if self._marker(run, "failed").exists():
+            return "failed"
+        return "new"
+
+    def expire(self):
+        """
+        mark the stale runs as failed: runs started longer than timeout ago (i.e. killed for exceeding the walltime)
+        and runs queued longer than queue_timeout ago (i.e. deleted from the queue or never started).
+
+        Returns
+        -------
+        list of expired runs
+        """
+        ret = []
+        for run, state in self.status().items():
+            if state != "stale":
+                continue
+            reason = "timeout" if self._marker(run, "started").exists() else "queue_timeout"
+            _remove(self._marker(run, "started"))
+            _remove(self._marker(run, "queued"))
+            with open(self._marker(run, "failed"), "a") as f:
+                f.write(f"{time.time()} {reason}\n")
+            ret.append(run)
+        return ret
+
+    def status(self):
+        """
+        dict of run: state of all runs submitted so far
+        """
+        runs = {int(f.name.split(".")[0]) for f in self.status_path.iterdir() if f.name.split(".")[0].isdigit()}
+        return {run: self.state(run) for run in sorted(runs)}
+
+    def submit(self, runs, newer_than=None, force=False):
+        """
+        submit the runs without a (current) result that are not queued or running
+
+        Parameters
+        ----------
+        runs: run numbers, i.e. range(start, getNewestRun())
+        newer_than: results older than this timestamp or the modification time of this file are recomputed.
+            their checkpoints are removed, so they are not resumed from the state of the old analysis
+        force: submit all runs that are not queued or running, regardless of the results
+
+        Returns
+        -------
+        list of submitted runs
+        """
+        runs = [int(r) for r in runs]
+        self.expire()
+        if not force:
+            runs = pending_runs(runs, self.results, newer_than)
+        runs = [run for run in runs if self.state(run) not in ("queued", "running")]
+        if len(runs) == 0:
+            return []
+        elements = pack_runs(runs, self.runs_per_job)
+        planfile = self.workdir / f"plan_{time.strftime('%Y%m%d-%H%M%S')}_{runs[0]}_{len(list(self.workdir.glob('plan_*.json')))}.json"
+        tmpfile = planfile.with_name(f".{planfile.name}.tmp")
+        with open(tmpfile, "w") as f:
+            json.dump({"script": str(self.script.resolve()), "args": self.args, "results": str(self.results.resolve()), "status": str(self.status_path.resolve()), "elements": elements}, f)
+        os.replace(tmpfile, planfile)
+        for run in runs:
+            _remove(self._marker(run, "done"))
+        if newer_than is not None:
+            outdated = set(runs)
+            for runnr, file in run_files(self.results):
+                if runnr in outdated:
+                    _remove(checkpoint_file(file))
+        submitted = time.time()
+        # raises if the submission failed, then no run is marked as queued
+        self.backend.submit(planfile, range(1, len(elements) + 1))
+        for run in runs:
+            # the job may already have started or even finished
+            ages = [self._age(run, state) for state in ("started", "done", "failed")]
+            if not any(age is not None and age <= time.time() - submitted for age in ages):
+                self._marker(run, "queued").touch()
+        return runs
+
+    def resubmit_failed(self):
+        """
+        resubmit the failed (and stale, see expire) runs with less than max_retries failures
+
+        Returns
+        -------
+        list of resubmitted runs
+        """
+        self.expire()
+        runs = [run for run, state in self.status().items() if state == "failed" and self.failures(run) <= self.max_retries]
+        return self.submit(runs, force=True)
+
+    def wait(self, poll_interval=60, resubmit=True):
+        """
+        wait until no runs are queued or running, resubmitting failed runs.
+        stale runs are marked as failed.
+        """
+        while True:
+            self.backend.wait()
+            self.expire()
+            if resubmit:
+                self.resubmit_failed()
+            if not any(state in ("queued", "running") for state in self.status().values()):
+                return self.status()
+            time.sleep(poll_interval)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="submit the analysis of runs without results")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("submit", help="submit missing or outdated runs")
+    p.add_argument("start", type=int)
+    p.add_argument("end", type=int, nargs="?", help="last run (inclusive), default: the newest finished run")
+    p.add_argument("--results", default="/work/kuschel/2023TRsHardXray/scratch/ulmer/data/run_data/")
+    p.add_argument("--workdir", default="jobs")
+    p.add_argument("--runs-per-job", type=int, default=5)
+    p.add_argument("--local", type=int, default=0, metavar="WORKERS", help="run on this machine with WORKERS processes instead of PBS")
+    p.add_argument("--wait", action="store_true", help="wait for the jobs and resubmit failures")
+    p.add_argument("--outdated", action="store_true", help="also recompute results older than the analysis script, without resuming from their checkpoints")
+    p = sub.add_parser("status", help="show the state of the submitted runs")
+    p.add_argument("--workdir", default="jobs")
+    p = sub.add_parser("element", help="run one array element of a plan (used by the jobs)")
+    p.add_argument("plan")
+    p.add_argument("index", type=int)
+    args = parser.parse_args()
+
+    if args.command == "element":
+        sys.exit(1 if run_element(args.plan, args.index) else 0)
+    elif args.command == "status":
+        orchestrator = Orchestrator(results=".", workdir=args.workdir)
+        for run, state in orchestrator.status().items():
+            print(run, state)
+    elif args.command == "submit":
+        if args.end is None:
+            from data_helper import getNewestRun
+
+            # the newest run may still be acquiring
+            args.end = getNewestRun() - 1
+        backend = LocalBackend(args.local) if args.local else PBSBackend()
+        orchestrator = Orchestrator(args.results, args.workdir, backend, runs_per_job=args.runs_per_job)
+        submitted = orchestrator.submit(range(args.start, args.end + 1), newer_than=ANALYSE if args.outdated else None)
+        print(f"submitted {len(submitted)} runs")
+        if args.wait:
+            for run, state in orchestrator.wait(poll_interval=5 if args.local else 60).items():
+                print(run, state)
@@ -0,0 +1,447 @@
+# felix zimmermann, github.com/fzimmermann89 for beamtime kuschel2023
+
+"""
+Declarative analysis pipelines.
+
+A pipeline spec is a dict of name: stage, each stage a dict with the keys "stage" (the type),
+"input" (a detector, a database key or the name of another stage) and the parameters of the stage, e.g.
+
+    {
+        "side_cut": {"stage": "noise_cut", "input": "side_ccd", "threshold": 1000},
+        "side_total": {"stage": "sum", "input": "side_cut"},
+        "side_mean": {"stage": "mean", "input": "side_cut"},
+    }
+
+Per shot stages (TRANSFORMS) calculate a value from their input. Their values are saved for each shot
+if "pershot" is True (default for "sum", "count" and "region").
+"roi" crops a rectangle of an image, "region" is the sum, mean or count over a calculators.ROI
+(rectangles and polygons, with the parameters of ROI, or an ROI as "roi", i.e. {"roi": side_roi, "reduce": "mean"}).
+Reductions (REDUCTIONS) accumulate their input over all shots:
+    "mean", "max", "min", "var": the accumulators of the same name
+    "topk": keeps the values of the stages in "keep" (default: the input) of the k shots with
+            the largest value of the scalar stage "by" (default: the input). they are returned as
+            "{name}_{stage}" and "{name}_shots", or by the result names in "names" (keep, by and the shot indices)
+Sparse frames of low occupancy detectors are made by "hits" (see calculators.HitFinder).
+"hit_values" and "hit_count" are the values and the number of hits, "sparse_sum" the sum image
+and "events" collects the frames into a sparse event file (see run_pipeline).
+Photons are counted by "droplets" (see droplets.DropletCounter), with "photon_map", "photon_count"
+and "droplet_energy" (for a histogram of the photon energies).
+See exp_config.analysis_pipeline for an example.
+"""
+
+import numpy as np
+import accumulators
+from calculators import NoiseCutter, Histogrammer, RangeCounter, Projection, RadialProfile, HitFinder, ROI, topk
+from sparse import SparseEvents, save_events
+from droplets import DropletCounter
+from data_helper import Run, to_dict
+from filters import filter_shutter, filter_xstep
+
+
+class Crop:
+    def __init__(self, rows=None, cols=None):
+        """
+        a rectangular region of an image, rows and cols as slices or (start, stop)
+        """
+        self.rows = rows if isinstance(rows, slice) else slice(*(rows or (None,)))
+        self.cols = cols if isinstance(cols, slice) else slice(*(cols or (None,)))
+
+    def __call__(self, image):
+        return np.asarray(image)[..., self.rows, self.cols]
+
+
+def _region(roi=None, **params):
+    """
+    a calculators.ROI from its parameters, or of the region of roi with the other parameters replaced
+    """
+    if roi is None:
+        return ROI(**params)
+    settings = dict(rectangles=roi.rectangles, polygons=roi.polygons, reduce=roi.reduce, low=roi.low, high=roi.high)
+    settings.update(params)
+    return ROI(**settings)
+
+
+def _param_key(value):
+    # the repr of an ROI does not describe its region, the same ROI object is the same region
+    return ("ROI", id(value)) if isinstance(value, ROI) else value
+
+
+def _sum():
+    return np.sum
+
+
+def _hit_values():
+    return lambda frame: frame.value
+
+
+def _hit_count():
+    return len
+
+
+def _photon_map():
+    return lambda droplets: droplets.photon_map()
+
+
+def _photon_count():
+    return lambda droplets: droplets.total
+
+
+def _droplet_energy():
+    return lambda droplets: droplets.energy
+
+
+TRANSFORMS = {
+    "noise_cut": NoiseCutter,
+    "roi": Crop,
+    "region": _region,
+    "histogram": Histogrammer,
+    "projection": Projection,
+    "radial_profile": RadialProfile,
+    "count": RangeCounter,
+    "sum": _sum,
+    "hits": HitFinder,
+    "hit_values": _hit_values,
+    "hit_count": _hit_count,
+    "droplets": DropletCounter,
+    "photon_map": _photon_map,
+    "photon_count": _photon_count,
+    "droplet_energy": _droplet_energy,
+}
+
+REDUCTIONS = {
+    "mean": accumulators.Mean,
+    "max": accumulators.Maximum,
+    "min": accumulators.Minimum,
+    "var": accumulators.Variance,
+    "topk": topk,
+    "sparse_sum": accumulators.SparseSum,
+    "events": SparseEvents,
+}
+
+# stages saved per shot by default
+PERSHOT = ("sum", "count", "region", "hit_count", "photon_count")
+
+# stages mostly spent in numpy functions holding the GIL (np.bincount), run in processes by mode="auto"
+GIL_BOUND = ("histogram", "radial_profile", "droplets")
+
+
+class _Stage:
+    def __init__(self, name, spec):
+        if not isinstance(spec, dict) or "stage" not in spec or "input" not in spec:
+            raise ValueError(f"stage {name} needs a 'stage' and an 'input'")
+        self.name = name
+        self.type = spec["stage"]
+        if self.type not in TRANSFORMS and self.type not in REDUCTIONS:
+            raise ValueError(f"unknown stage {self.type} of {name}")
+        self.input = spec["input"]
+        self.pershot = spec.get("pershot", self.type in PERSHOT)
+        self.params = {key: value for key, value in spec.items() if key not in ("stage", "input", "pershot")}
+        if self.type == "topk":
+            self.by = self.params.pop("by", self.input)
+            self.keep = list(self.params.pop("keep", [self.input]))
+            # the resolved names of by and keep may differ, the results use these
+            self.output_names = [f"{name}_{field}" for field in self.keep + [self.by, "shots"]]
+            names = self.params.pop("names", None)
+            if names is not None:
+                if len(names) != len(self.output_names):
+                    raise ValueError(f"topk {name} needs {len(self.output_names)} names: the kept stages, by and the shots")
+                self.output_names = list(names)
+
+    @property
+    def reduction(self):
+        return self.type in REDUCTIONS
+
+    def make(self):
+        """
+        a new calculator or accumulator of this stage
+        """
+        if self.reduction:
+            return REDUCTIONS[self.type](**self.params)
+        return TRANSFORMS[self.type](**self.params)
+
+
+class Pipeline:
+    def __init__(self, spec):
+        """
+        Plans the execution of a pipeline spec (see the module docstring):
+         - stages with the same type, input and parameters are calculated only once
+         - stages not needed for any result are dropped
+         - all stages are calculated in one pass per shot, in dependency order
+         - only detectors and database keys used as inputs are read. detectors only used by one
+           projection stage are read as projections (see Detector)
+        """
+        self.spec = spec
+        stages = {name: _Stage(name, s) for name, s in spec.items()}
+        self.alias = {}  # name: name of the stage calculating the same value
+        self.order = []  # transforms in execution order
+        self.reductions = []
+        canonical = {}
+
+        def resolve(name, path=()):
+            if name in self.alias:
+                return self.alias[name]
+            if name not in stages:
+                # a field of the shot
+                return name
+            if name in path:
+                raise ValueError(f"cycle in pipeline: {' -> '.join(path + (name,))}")
+            stage = stages[name]
+            stage.input = resolve(stage.input, path + (name,))
+            if stage.type == "topk":
+                stage.by = resolve(stage.by, path + (name,))
+                stage.keep = [resolve(k, path + (name,)) for k in stage.keep]
+            if stage.reduction:
+                if any(stages[n].reduction for n in [stage.input] + ([stage.by] + stage.keep if stage.type == "topk" else []) if n in stages):
+                    raise ValueError(f"the input of {name} is a reduction, not a per shot value")
+                self.alias[name] = name
+                self.reductions.append(stage)
+                return name
+            key = (stage.type, stage.input, repr(sorted((k, _param_key(v)) for k, v in stage.params.items())))
+            if key not in canonical:
+                canonical[key] = name
+                self.order.append(stage)
+            self.alias[name] = canonical[key]
+            return canonical[key]
+
+        for name in stages:
+            resolve(name)
+
+        # pershot columns by the name given in the spec
+        self.pershot = {name: self.alias[name] for name, stage in stages.items() if stage.pershot and not stage.reduction}
+
+        # only the stages needed for the results
+        direct = set(self.pershot.values())
+        for stage in self.reductions:
+            direct.update([stage.input] + ([stage.by] + stage.keep if stage.type == "topk" else []))
+        needed = set(direct)
+        for stage in reversed(self.order):
+            if stage.name in needed:
+                needed.add(stage.input)
+        self.order = [stage for stage in self.order if stage.name in needed]
+        names = {stage.name for stage in self.order}
+        self.fields = sorted(name for name in needed if name not in names)
+
+        # a detector only used by a single projection is read as a projection
+        self.projections = {}
+        for stage in self.order:
+            if stage.type == "projection" and stage.input in self.fields and stage.input not in direct and sum(s.input == stage.input for s in self.order) == 1:
+                self.projections[stage.input] = stage
+
+    def __repr__(self):
+        return f"Pipeline of {len(self.order)} per shot stages and {len(self.reductions)} reductions on {', '.join(self.fields)}"
+
+    @property
+    def gil_bound(self):
+        return any(stage.type in GIL_BOUND for stage in self.order)
+
+    def make_run(self, runNR, detector_keys, database_keys, detector_dark_paths=None, bl=3):
+        """
+        a Run with only the detectors used by the pipeline. all database keys are kept for the results.
+        """
+        projections = {name: stage.make() for name, stage in self.projections.items()}
+        fields = set(self.fields) | set(database_keys)
+        return Run(detector_keys, database_keys, detector_dark_paths, bl=bl, run=int(runNR), detector_projections=projections, fields=fields)
+
+    def make_transforms(self):
+        """
+        new calculators for all per shot stages. projections read by the detector are the identity.
+        """
+        return [(stage, None if self.projections.get(stage.input) is stage else stage.make()) for stage in self.order]
+
+    def make_accumulators(self):
+        return {stage.name: stage.make() for stage in self.reductions}
+
+    def calculate(self, shot, transforms):
+        """
+        the values of all stages for one shot as dict by (canonical) name
+        """
+        values = {field: np.asarray(getattr(shot, field)) for field in self.fields}
+        for stage, calculator in transforms:
+            values[stage.name] = values[stage.input] if calculator is None else calculator(values[stage.input])
+        return values
+
+    def accumulate(self, accs, values, index):
+        for stage in self.reductions:
+            if stage.type == "topk":
+                accs[stage.name].add(values[stage.by], tuple(values[k] for k in stage.keep) + (values[stage.by], index))
+            elif stage.type == "events":
+                accs[stage.name].add(values[stage.input], index)
+            else:
+                accs[stage.name].accumulate(values[stage.input])
+
+    def pershot_values(self, values):
+        """
+        the values of the pershot stages by the name given in the spec
+        """
+        return {name: values[stage] for name, stage in self.pershot.items()}
+
+    def columns(self, values):
+        """
+        PerShotRecorder columns of the pershot stages, given the values of one shot
+        """
+        columns = {}
+        for name, stage in self.pershot.items():
+            value = np.asarray(values[stage])
+            columns[name] = value.dtype if value.ndim == 0 else (value.dtype, value.shape)
+        return columns
+
+    def constants(self):
+        """
+        values not depending on the shots, i.e. the centers of histograms
+        """
+        ret = {}
+        for name, alias in self.alias.items():
+            stage = next((s for s in self.order if s.name == alias), None)
+            if stage is not None and stage.type == "histogram":
+                ret[f"{name}_centers"] = stage.make().centers()
+        return ret
+
+    def results(self, accs):
+        """
+        the accumulators as to_dict arguments, topk are converted to arrays. events are not included.
+        """
+        ret = {}
+        for stage in self.reductions:
+            acc = accs[stage.name]
+            if stage.type == "events":
+                continue
+            if stage.type != "topk":
+                ret[stage.name] = acc
+                continue
+            entries = acc.get()
+            for j, field in enumerate(stage.output_names):
+                ret[field] = np.array([entry[j] for entry in entries])
+        return ret
+
+
+def default_select(run):
+    """
+    the shot selection of analyserun
+    """
+    return filter_shutter(run)(filter_xstep(run)())
+
+
+def process_shots(pipeline, run, good_shots, rows, accs, pershot, progress=False):
+    """
+    calculate and accumulate the pipeline for the rows of good_shots, in one pass per shot
+    """
+    transforms = pipeline.make_transforms()
+    if progress:
+        from tqdm import tqdm  # slow to import
+
+        rows = tqdm(rows)
+    for j in rows:
+        i = good_shots[j]
+        values = pipeline.calculate(run[i], transforms)
+        pershot.record(j, **pipeline.pershot_values(values))
+        pipeline.accumulate(accs, values, i)
+    return accs
+
+
+def _process_chunk(spec, run_args, good_shots, rows, pershot):
+    """
+    process some shots in a worker process with its own Pipeline and Run
+    """
+    pipeline = Pipeline(spec)
+    accs = pipeline.make_accumulators()
+    return process_shots(pipeline, pipeline.make_run(*run_args), good_shots, rows, accs, pershot)
+
+
+def _merge(pipeline, chunks):
+    merged = chunks[0]
+    for other in chunks[1:]:
+        for stage in pipeline.reductions:
+            if stage.type == "topk":
+                merged[stage.name].merge(other[stage.name])
+            else:
+                merged[stage.name].accumulate(other[stage.name])
+    return merged
+
+
+def run_pipeline(
+    runNR,
+    spec,
+    detector_keys,
+    database_keys,
+    detector_dark_paths=None,
+    bl=3,
+    select=default_select,
+    max_shots=np.inf,
+    step_shots=1,
+    workers=1,
+    mode="auto",
+    progress=True,
+    events_path=None,
+    **extra,
+):
+    """
+    Analyse a run with a pipeline spec.
+
+    Parameters
+    ----------
+    runNR: run number
+    spec: pipeline spec, see the module docstring
+    detector_keys, database_keys, detector_dark_paths, bl: see Run. only the used detectors are read.
+    select: callable(run) returning the indices of the good shots
+    max_shots, step_shots: use only every step_shots good shot, at most max_shots
+    workers: number of parallel workers. the shots are split into contiguous chunks with
+        their own accumulators, which are merged in order.
+    mode: "serial", "thread", "process" or "auto": serial for one worker or few shots,
+        processes if stages holding the GIL are used, threads otherwise
+    events_path: file name of the sparse event files of "events" stages, formatted with name and run,
+        i.e. "events/{name}_run{run}.npz". see sparse.load_events
+    extra: additional values for the result, i.e. the spectrometer axis
+
+    Returns
+    -------
+    dict of results as by to_dict: the database values of the good shots, the accumulators
+    (with their states), the pershot columns, the topk arrays, histogram centers and extra
+    """
+    pipeline = Pipeline(spec)
+    if events_path is None and any(stage.type == "events" for stage in pipeline.reductions):
+        raise ValueError("events stages need an events_path")
+    run_args = (runNR, detector_keys, database_keys, detector_dark_paths, bl)
+    run = pipeline.make_run(*run_args)
+    good_shots = np.asarray(select(run))
+    good_shots = good_shots[range(0, int(min(max_shots, len(good_shots))), step_shots)]
+    if len(good_shots) == 0:
+        raise ValueError(f"no good shots in run {runNR}")
+
+    if mode == "auto":
+        if workers <= 1 or len(good_shots) < 10 * workers:
+            mode = "serial"
+        else:
+            mode = "process" if pipeline.gil_bound else "thread"
+    if mode not in ("serial", "thread", "process"):
+        raise ValueError("mode must be 'serial', 'thread', 'process' or 'auto'")
+
+    # the shape and type of the pershot values are taken from the first shot, which is processed here
+    first = pipeline.calculate(run[good_shots[0]], pipeline.make_transforms())
+    pershot = accumulators.PerShotRecorder(len(good_shots), pipeline.columns(first), shared=mode == "process")
+    pershot.record(0, **pipeline.pershot_values(first))
+    accs = pipeline.make_accumulators()
+    pipeline.accumulate(accs, first, good_shots[0])
+    rows = np.arange(1, len(good_shots))
+
+    if mode == "serial":
+        accs = process_shots(pipeline, run, good_shots, rows, accs, pershot, progress=progress)
+    else:
+        chunks = np.array_split(rows, workers)
+        if mode == "thread":
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(process_shots, pipeline, run.copy(), good_shots, chunk, pipeline.make_accumulators(), pershot) for chunk in chunks]
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(_process_chunk, spec, run_args, good_shots, chunk, pershot) for chunk in chunks]
+        accs = _merge(pipeline, [accs] + [f.result() for f in futures])
+
+    for stage in pipeline.reductions:
+        if stage.type == "events":
+            events = accs[stage.name]
+            save_events(str(events_path).format(name=stage.name, run=runNR), events, tag=run.tag[events.shots], runNR=runNR)
+
+    return to_dict(run, shots_taken=good_shots, **pipeline.results(accs), **pipeline.constants(), pershot=pershot, runNR=runNR, **extra)
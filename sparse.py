@@ -0,0 +1,245 @@
+# felix zimmermann, github.com/fzimmermann89 for beamtime kuschel2023
+
+"""
+Sparse representation of low occupancy frames: only the pixels above a threshold
+are kept as flat pixel indices and values, optionally labeled by connected cluster.
+"""
+
+import os
+import numpy as np
+from pathlib import Path
+import accumulators
+
+
+class SparseFrame:
+    __slots__ = ("index", "value", "shape", "labels")
+
+    def __init__(self, index, value, shape, labels=None):
+        """
+        The hits of a frame (or a stack of frames).
+
+        Parameters
+        ----------
+        index: sorted flat indices of the hit pixels
+        value: values of the hit pixels
+        shape: shape of the dense frame
+        labels: None or the cluster number of each hit, see label_hits
+        """
+        self.index = index
+        self.value = value
+        self.shape = tuple(shape)
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.index)
+
+    def __repr__(self):
+        clusters = "" if self.labels is None else f" in {self.n_clusters} clusters"
+        return f"SparseFrame with {len(self)} hits{clusters} of shape {self.shape}"
+
+    @property
+    def n_clusters(self):
+        return 0 if self.labels is None or len(self.labels) == 0 else int(self.labels.max()) + 1
+
+    def dense(self, fill_value=0.0):
+        """
+        the frame as dense array, pixels without a hit set to fill_value
+        """
+        ret = np.full(self.shape, fill_value, dtype=np.result_type(self.value, fill_value))
+        ret.ravel()[self.index] = self.value
+        return ret
+
+    def clusters(self):
+        """
+        properties of the clusters as dict of arrays with one entry per cluster:
+        sum (of the values), size (number of pixels), max (largest value) and
+        the value weighted center of mass in pixels, one array per axis in center
+        """
+        if self.labels is None:
+            raise ValueError("the frame is not labeled, use label_hits or HitFinder(cluster=True)")
+        n = self.n_clusters
+        total = np.bincount(self.labels, self.value, minlength=n)
+        size = np.bincount(self.labels, minlength=n)
+        largest = np.full(n, -np.inf)
+        np.maximum.at(largest, self.labels, self.value)
+        coords = np.unravel_index(self.index, self.shape)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            center = [np.bincount(self.labels, self.value * c, minlength=n) / total for c in coords]
+        return {"sum": total, "size": size, "max": largest, "center": center}
+
+
+def label_hits(index, shape, connectivity=4):
+    """
+    connected clusters of hit pixels, vectorized on the sparse indices.
+    For a stack of frames (ndim>2) pixels are only connected within each frame.
+
+    Parameters
+    ----------
+    index: sorted flat indices of the hits in an array of shape
+    shape: shape of the dense frame or stack, the last two axes are the image axes
+    connectivity: 4 (edges) or 8 (edges and corners)
+
+    Returns
+    -------
+    cluster number of each hit, numbered from 0 in order of the first pixel
+    """
+    if connectivity not in (4, 8):
+        raise ValueError("connectivity must be 4 or 8")
+    index = np.asarray(index)
+    n = len(index)
+    if n == 0:
+        return np.zeros(0, dtype=np.intp)
+    nrows, ncols = shape[-2], shape[-1]
+    row = (index // ncols) % nrows
+    col = index % ncols
+    neighbours = [(1, col < ncols - 1), (ncols, row < nrows - 1)]
+    if connectivity == 8:
+        neighbours += [(ncols + 1, (row < nrows - 1) & (col < ncols - 1)), (ncols - 1, (row < nrows - 1) & (col > 0))]
+    a, b = [], []
+    for offset, valid in neighbours:
+        j = np.minimum(np.searchsorted(index, index + offset), n - 1)
+        connected = valid & (index[j] == index + offset)
+        a.append(np.flatnonzero(connected))
+        b.append(j[connected])
+    a = np.concatenate(a)
+    b = np.concatenate(b)
+    # propagate the smallest hit number through each cluster, with pointer jumping
+    labels = np.arange(n)
+    while True:
+        smallest = np.minimum(labels[a], labels[b])
+        new = labels.copy()
+        np.minimum.at(new, a, smallest)
+        np.minimum.at(new, b, smallest)
+        new = new[new]
+        if np.array_equal(new, labels):
+            break
+        labels = new
+    return np.unique(labels, return_inverse=True)[1].reshape(-1)
+
+
+class SparseEvents(accumulators.Accumulator):
+    """
+    Collects the sparse frames of many shots, i.e. to save them with save_events for a later re-analysis.
+    The hits of all shots are kept in concatenated arrays.
+    Use add(frame, shot) to keep the shot number, accumulate(frame) numbers the shots consecutively.
+    """
+
+    def __init__(self):
+        self._index = []
+        self._value = []
+        self._labels = []
+        self._lengths = []
+        self._shots = []
+        self._shape = None
+
+    def add(self, frame, shot):
+        if self._shape is None:
+            self._shape = frame.shape
+        elif frame.shape != self._shape:
+            raise ValueError(f"shape {frame.shape} of the frame does not match {self._shape}")
+        self._index.append(np.asarray(frame.index, dtype=np.int64))
+        self._value.append(np.asarray(frame.value, dtype=np.float32))
+        if frame.labels is not None:
+            self._labels.append(np.asarray(frame.labels, dtype=np.int32))
+        self._lengths.append(len(frame))
+        self._shots.append(shot)
+        return self
+
+    def _accumulate_obj(self, obj):
+        self.add(obj, len(self._shots))
+
+    def _accumulate_other(self, other):
+        # keeps the order, i.e. merge the chunks of a run in order
+        self._concatenate()
+        other._concatenate()
+        if other._shape is not None:
+            if self._shape is not None and other._shape != self._shape:
+                raise ValueError("shapes do not match")
+            self._shape = other._shape
+        self._index += other._index
+        self._value += other._value
+        self._labels += other._labels
+        self._lengths += other._lengths
+        self._shots += other._shots
+
+    def _concatenate(self):
+        if len(self._index) > 1:
+            self._index = [np.concatenate(self._index)]
+            self._value = [np.concatenate(self._value)]
+            self._labels = [np.concatenate(self._labels)] if self._labels else []
+        return self
+
+    def _state(self):
+        self._concatenate()
+        state = {
+            "index": self._index[0] if self._index else np.zeros(0, dtype=np.int64),
+            "value": self._value[0] if self._value else np.zeros(0, dtype=np.float32),
+            "lengths": np.asarray(self._lengths, dtype=np.int64),
+            "shots": np.asarray(self._shots, dtype=np.int64),
+            "shape": np.asarray(self._shape if self._shape is not None else (), dtype=np.int64),
+        }
+        if self._labels and len(self._labels[0]) == len(state["index"]):
+            state["labels"] = self._labels[0]
+        return state
+
+    @classmethod
+    def _from_state(cls, state):
+        ret = cls()
+        ret._index = [np.asarray(state["index"])]
+        ret._value = [np.asarray(state["value"])]
+        ret._labels = [np.asarray(state["labels"])] if "labels" in state else []
+        ret._lengths = [int(length) for length in state["lengths"]]
+        ret._shots = [int(shot) for shot in state["shots"]]
+        ret._shape = tuple(int(s) for s in state["shape"]) or None
+        return ret
+
+    def __getitem__(self, k):
+        """
+        the SparseFrame of the k-th collected shot
+        """
+        self._concatenate()
+        offsets = np.concatenate(([0], np.cumsum(self._lengths)))
+        part = slice(offsets[k], offsets[k + 1])
+        labels = self._labels[0][part] if self._labels and len(self._labels[0]) == offsets[-1] else None
+        return SparseFrame(self._index[0][part], self._value[0][part], self._shape, labels)
+
+    def __len__(self):
+        return len(self._shots)
+
+    @property
+    def shots(self):
+        return np.asarray(self._shots)
+
+    @property
+    def value(self):
+        return self
+
+    @property
+    def n(self):
+        return len(self._shots)
+
+
+def save_events(path, events, **extra):
+    """
+    atomically save SparseEvents (and extra arrays, i.e. tags and runNR) to an npz file
+    """
+    path = Path(path)
+    tmpfile = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmpfile, "wb") as f:
+        np.savez_compressed(f, **events.state_dict(), **extra)
+    os.replace(tmpfile, path)
+
+
+def load_events(path):
+    """
+    load SparseEvents saved with save_events
+
+    Returns
+    -------
+    SparseEvents, dict of the extra arrays
+    """
+    with np.load(path) as f:
+        data = {key: f[key] for key in f.files}
+    state = {key: value for key, value in data.items() if key in ("_class", "_version", "index", "value", "labels", "lengths", "shots", "shape")}
+    extra = {key: value for key, value in data.items() if key not in state}
+    return accumulators.Accumulator.from_state(state), extra
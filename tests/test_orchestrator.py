@@ -0,0 +1,55 @@
+# felix zimmermann, github.com/fzimmermann89 for beamtime kuschel2023
+
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from orchestrator import Orchestrator, LocalBackend  # noqa: E402
+
+# resumes from the checkpoint next to the result, as analyse.py does
+SCRIPT = """
+import sys
+import numpy as np
+from pathlib import Path
+
+VALUE = {value}
+outdir = Path(sys.argv[-1])
+for run in sys.argv[1:-1]:
+    result = outdir / f"data1_run{{run}}.npz"
+    checkpoint = result.with_name(f".{{result.name}}.checkpoint")
+    value = float(np.load(checkpoint)["value"]) if checkpoint.exists() else VALUE
+    with open(checkpoint, "wb") as f:
+        np.savez(f, value=value)
+    with open(result, "wb") as f:
+        np.savez(f, value=value, runNR=int(run))
+"""
+
+
+def _value(results, run):
+    with np.load(results / f"data1_run{run}.npz") as f:
+        return float(f["value"])
+
+
+def test_outdated_runs_are_recomputed(tmp_path):
+    script = tmp_path / "analysis.py"
+    results = tmp_path / "results"
+    results.mkdir()
+    script.write_text(SCRIPT.format(value=1.0))
+    orchestrator = Orchestrator(results, tmp_path / "jobs", LocalBackend(2), script=script, args=[results], runs_per_job=2)
+
+    assert orchestrator.submit([1, 2, 3]) == [1, 2, 3]
+    assert set(orchestrator.wait(poll_interval=0.1).values()) == {"done"}
+    assert [_value(results, run) for run in (1, 2, 3)] == [1.0, 1.0, 1.0]
+    assert orchestrator.submit([1, 2, 3], newer_than=script) == []
+
+    # a changed analysis makes all results outdated
+    time.sleep(0.05)
+    script.write_text(SCRIPT.format(value=2.0))
+    assert orchestrator.submit([1, 2, 3], newer_than=script) == [1, 2, 3]
+    assert set(orchestrator.wait(poll_interval=0.1).values()) == {"done"}
+    assert [_value(results, run) for run in (1, 2, 3)] == [2.0, 2.0, 2.0]
+    assert orchestrator.submit([1, 2, 3], newer_than=script) == []